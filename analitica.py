@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Analítica Columnar - Sistema de Gestión de Fábrica
+Snapshot en columnas NumPy de ventas, gastos y producción
+"""
+
+import threading
+
+import numpy as np
+from sqlalchemy import case, func, select
+
+from models import db, Venta, Gasto, Produccion, ResumenArchivado
+
+# Códigos de tipo de gasto en la columna 'tipo'
+TIPO_OTRO = 0
+TIPO_FABRICA = 1
+TIPO_PERSONAL = 2
+
+# Columnas de cada tabla (todas enteras); la primera siempre es el id
+COLUMNAS = {
+    'ventas': ('id', 'producto_id', 'produccion_id', 'cantidad', 'precio', 'descuento',
+               'ganancia', 'periodo'),
+    'gastos': ('id', 'monto', 'tipo', 'periodo'),
+    'produccion': ('id', 'producto_id', 'cantidad', 'costo_unitario', 'periodo')
+}
+
+# Columnas de la BD que alimentan el snapshot: solo un UPDATE de estas obliga
+# a recargar la tabla (editar un concepto o una fecha no)
+COLUMNAS_ORIGEN = {
+    'ventas': ('producto_id', 'produccion_id', 'cantidad', 'precio_aplicado', 'descuento',
+               'ganancia_real', 'mes_venta', 'anio_venta'),
+    'gastos': ('monto', 'tipo', 'mes_gasto', 'anio_gasto'),
+    'produccion': ('producto_id', 'cantidad', 'costo_unitario_calculado', 'mes', 'anio')
+}
+
+# Resumen mensual de los años archivados (se recarga completo, es pequeño)
+COLUMNAS_RESUMEN = ('periodo', 'ventas', 'ganancias', 'gastos_fabrica', 'gastos_personal',
+                    'unidades_vendidas')
+
+
+def codigo_periodo(mes, anio):
+    """Periodo como entero AAAAMM (ej. 202602)"""
+    return anio * 100 + mes
+
+
+def _consulta(tabla, desde_id):
+    """SELECT de las columnas de una tabla para los ids mayores a desde_id"""
+    if tabla == 'ventas':
+        columnas = (Venta.id, Venta.producto_id, Venta.produccion_id, Venta.cantidad,
+                    Venta.precio_aplicado, func.coalesce(Venta.descuento, 0),
+                    func.coalesce(Venta.ganancia_real, 0),
+                    Venta.anio_venta * 100 + Venta.mes_venta)
+        modelo = Venta
+    elif tabla == 'gastos':
+        tipo = case((Gasto.tipo == 'Fabrica', TIPO_FABRICA),
+                   (Gasto.tipo == 'Personal', TIPO_PERSONAL), else_=TIPO_OTRO)
+        columnas = (Gasto.id, Gasto.monto, tipo, Gasto.anio_gasto * 100 + Gasto.mes_gasto)
+        modelo = Gasto
+    else:
+        columnas = (Produccion.id, Produccion.producto_id, Produccion.cantidad,
+                    func.coalesce(Produccion.costo_unitario_calculado, 0),
+                    Produccion.anio * 100 + Produccion.mes)
+        modelo = Produccion
+    return select(*columnas).where(modelo.id > desde_id).order_by(modelo.id)
+
+
+def crear_contadores(engine):
+    """Tabla contador_cambios y triggers que la incrementan al modificar o borrar filas
+
+    Las altas se detectan por id; los cambios y borrados (incluso desde
+    otra conexión) suben la versión de la tabla y fuerzan su recarga.
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            'CREATE TABLE IF NOT EXISTS contador_cambios '
+            '(tabla TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)')
+        for tabla in COLUMNAS:
+            conn.exec_driver_sql(
+                'INSERT OR IGNORE INTO contador_cambios (tabla, version) VALUES (?, 0)', (tabla,))
+            eventos = {'update': f"UPDATE OF {', '.join(COLUMNAS_ORIGEN[tabla])}", 'delete': 'DELETE'}
+            for nombre, evento in eventos.items():
+                conn.exec_driver_sql(
+                    f'CREATE TRIGGER IF NOT EXISTS {tabla}_cambio_{nombre} AFTER {evento} ON {tabla} '
+                    f"BEGIN UPDATE contador_cambios SET version = version + 1 WHERE tabla = '{tabla}'; END")
+
+
+def _a_columnas(filas, nombres):
+    """Convierte filas de la BD en un dict de arrays int64"""
+    matriz = np.array(filas, dtype=np.int64).reshape(-1, len(nombres))
+    return {nombre: matriz[:, i].copy() for i, nombre in enumerate(nombres)}
+
+
+def sumar_por_grupo(claves, *valores):
+    """Suma exacta (int64) de cada array de valores agrupando por claves"""
+    if len(claves) == 0:
+        return np.empty(0, dtype=np.int64), [np.empty(0, dtype=np.int64) for _ in valores]
+    orden = np.argsort(claves, kind='stable')
+    claves_ordenadas = claves[orden]
+    inicios = np.flatnonzero(np.r_[True, claves_ordenadas[1:] != claves_ordenadas[:-1]])
+    sumas = [np.add.reduceat(v[orden], inicios) for v in valores]
+    return claves_ordenadas[inicios], sumas
+
+
+class AnaliticaColumnar:
+    """Copia en memoria, por columnas, de las tablas de movimientos
+
+    Se carga una vez y luego se refresca solo con los ids nuevos. Si se
+    modificaron o borraron filas (invalidar() o subió la versión de la
+    tabla en contador_cambios) la tabla se recarga completa.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datos = {tabla: _a_columnas([], nombres) for tabla, nombres in COLUMNAS.items()}
+        self._resumen = _a_columnas([], COLUMNAS_RESUMEN)
+        self._invalidas = set(COLUMNAS)
+        self._versiones = {}
+        self._con_contadores = False
+
+    def invalidar(self, tabla):
+        """Marca una tabla para recarga completa (tras un borrado)"""
+        self._invalidas.add(tabla)
+
+    def _ultimo_id(self, tabla):
+        ids = self._datos[tabla]['id']
+        return int(ids[-1]) if len(ids) else 0
+
+    def refrescar(self):
+        """Incorpora las filas nuevas; devuelve cuántas se leyeron por tabla"""
+        engine = db.session.get_bind()
+        agregadas = {}
+        with self._lock:
+            if not self._con_contadores:
+                crear_contadores(engine)
+                self._con_contadores = True
+
+            with engine.connect() as conn:
+                # Una sola transacción de lectura: versiones, filas nuevas y
+                # resumen salen del mismo estado de la base
+                conn.exec_driver_sql('BEGIN')
+                versiones = dict(conn.exec_driver_sql(
+                    'SELECT tabla, version FROM contador_cambios').all())
+
+                for tabla, nombres in COLUMNAS.items():
+                    if tabla in self._invalidas or versiones.get(tabla) != self._versiones.get(tabla):
+                        self._datos[tabla] = _a_columnas([], nombres)
+                        self._invalidas.discard(tabla)
+                    filas = conn.execute(_consulta(tabla, self._ultimo_id(tabla))).all()
+                    actual = self._datos[tabla]
+                    nuevas = _a_columnas(filas, nombres)
+                    self._datos[tabla] = {n: np.concatenate((actual[n], nuevas[n])) for n in nombres}
+                    agregadas[tabla] = len(filas)
+
+                r = ResumenArchivado
+                self._resumen = _a_columnas(conn.execute(select(
+                    r.anio * 100 + r.mes, func.coalesce(r.ventas, 0), func.coalesce(r.ganancias, 0),
+                    func.coalesce(r.gastos_fabrica, 0), func.coalesce(r.gastos_personal, 0),
+                    func.coalesce(r.unidades_vendidas, 0)
+                )).all(), COLUMNAS_RESUMEN)
+                self._versiones = versiones
+        return agregadas
+
+    def columnas(self, tabla):
+        """Arrays actuales de una tabla (no modificar)"""
+        return self._datos[tabla]
+
+    def filas(self):
+        return {tabla: len(cols['id']) for tabla, cols in self._datos.items()}
+
+    # ------------------------------------------------------------------
+    # Agregaciones
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _ingresos(ventas):
+        return ventas['precio'] * ventas['cantidad'] - ventas['descuento']
+
+    def totales_mes(self, mes, anio):
+        """Mismos totales que calcular_totales_mes(), sin consultar la BD"""
+        periodo = codigo_periodo(mes, anio)
+        ventas = self._datos['ventas']
+        gastos = self._datos['gastos']
+
+        resumen = self._resumen
+        en_resumen = resumen['periodo'] == periodo
+
+        en_periodo = ventas['periodo'] == periodo
+        total_ventas = int(self._ingresos(ventas)[en_periodo].sum() + resumen['ventas'][en_resumen].sum())
+        ganancias = int(ventas['ganancia'][en_periodo].sum() + resumen['ganancias'][en_resumen].sum())
+
+        gastos_periodo = gastos['periodo'] == periodo
+        gastos_fabrica = int(gastos['monto'][gastos_periodo & (gastos['tipo'] == TIPO_FABRICA)].sum()
+                             + resumen['gastos_fabrica'][en_resumen].sum())
+        gastos_personal = int(gastos['monto'][gastos_periodo & (gastos['tipo'] == TIPO_PERSONAL)].sum()
+                              + resumen['gastos_personal'][en_resumen].sum())
+
+        return {
+            'ventas': total_ventas,
+            'gastos_fabrica': gastos_fabrica,
+            'gastos_personal': gastos_personal,
+            'gastos_total': gastos_fabrica + gastos_personal,
+            'ganancias': ganancias,
+            'balance': total_ventas - (gastos_fabrica + gastos_personal)
+        }
+
+    def totales_por_periodo(self, desde=None, hasta=None):
+        """Totales de todos los períodos AAAAMM entre desde y hasta (inclusive)"""
+        ventas = self._datos['ventas']
+        gastos = self._datos['gastos']
+        resumen = self._resumen
+        v = self._mascara_periodo(ventas['periodo'], desde, hasta)
+        g = self._mascara_periodo(gastos['periodo'], desde, hasta)
+        r = self._mascara_periodo(resumen['periodo'], desde, hasta)
+
+        # Los meses archivados entran como filas ya agregadas
+        periodos_v, (ingresos, ganancias, unidades) = sumar_por_grupo(
+            np.concatenate((ventas['periodo'][v], resumen['periodo'][r])),
+            np.concatenate((self._ingresos(ventas)[v], resumen['ventas'][r])),
+            np.concatenate((ventas['ganancia'][v], resumen['ganancias'][r])),
+            np.concatenate((ventas['cantidad'][v], resumen['unidades_vendidas'][r])))
+
+        monto = gastos['monto'][g]
+        tipo = gastos['tipo'][g]
+        periodos_g, (fabrica, personal) = sumar_por_grupo(
+            np.concatenate((gastos['periodo'][g], resumen['periodo'][r])),
+            np.concatenate((np.where(tipo == TIPO_FABRICA, monto, 0), resumen['gastos_fabrica'][r])),
+            np.concatenate((np.where(tipo == TIPO_PERSONAL, monto, 0), resumen['gastos_personal'][r])))
+
+        periodos = np.union1d(periodos_v, periodos_g)
+        resultado = []
+        for periodo in periodos:
+            iv = np.searchsorted(periodos_v, periodo)
+            ig = np.searchsorted(periodos_g, periodo)
+            tiene_v = iv < len(periodos_v) and periodos_v[iv] == periodo
+            tiene_g = ig < len(periodos_g) and periodos_g[ig] == periodo
+            total_ventas = int(ingresos[iv]) if tiene_v else 0
+            gastos_fabrica = int(fabrica[ig]) if tiene_g else 0
+            gastos_personal = int(personal[ig]) if tiene_g else 0
+            resultado.append({
+                'periodo': int(periodo),
+                'mes': int(periodo % 100),
+                'anio': int(periodo // 100),
+                'unidades': int(unidades[iv]) if tiene_v else 0,
+                'ventas': total_ventas,
+                'ganancias': int(ganancias[iv]) if tiene_v else 0,
+                'gastos_fabrica': gastos_fabrica,
+                'gastos_personal': gastos_personal,
+                'gastos_total': gastos_fabrica + gastos_personal,
+                'balance': total_ventas - (gastos_fabrica + gastos_personal)
+            })
+        return resultado
+
+    def totales_por_producto(self, desde=None, hasta=None):
+        """Unidades vendidas, ingresos y ganancia por producto"""
+        ventas = self._datos['ventas']
+        produccion = self._datos['produccion']
+        v = self._mascara_periodo(ventas['periodo'], desde, hasta)
+        p = self._mascara_periodo(produccion['periodo'], desde, hasta)
+
+        productos, (unidades, ingresos, ganancias) = sumar_por_grupo(
+            ventas['producto_id'][v], ventas['cantidad'][v], self._ingresos(ventas)[v], ventas['ganancia'][v])
+        productos_p, (producido,) = sumar_por_grupo(
+            produccion['producto_id'][p], produccion['cantidad'][p])
+        producido_por_id = dict(zip(productos_p.tolist(), producido.tolist()))
+
+        return [{
+            'producto_id': int(pid),
+            'producido': producido_por_id.get(int(pid), 0),
+            'unidades': int(u),
+            'ventas': int(i),
+            'ganancias': int(g)
+        } for pid, u, i, g in zip(productos, unidades, ingresos, ganancias)]
+
+    def simular(self, precios=None, factor_precio=1.0, factor_descuento=1.0, desde=None, hasta=None):
+        """What-if: recalcula ingresos y ganancias con otros precios/descuentos
+
+        precios: {producto_id: nuevo_precio} reemplaza el precio aplicado de
+        todas las ventas de ese producto; factor_precio y factor_descuento
+        escalan el resto. El costo de cada venta se mantiene.
+        """
+        ventas = self._datos['ventas']
+        v = self._mascara_periodo(ventas['periodo'], desde, hasta)
+        producto_id = ventas['producto_id'][v]
+        cantidad = ventas['cantidad'][v]
+        precio = ventas['precio'][v]
+        descuento = ventas['descuento'][v]
+        ganancia = ventas['ganancia'][v]
+
+        ingresos = precio * cantidad - descuento
+        costo = ingresos - ganancia
+
+        nuevo_precio = np.rint(precio * factor_precio).astype(np.int64)
+        for pid, valor in (precios or {}).items():
+            nuevo_precio[producto_id == int(pid)] = int(valor)
+        nuevo_descuento = np.rint(descuento * factor_descuento).astype(np.int64)
+
+        nuevos_ingresos = nuevo_precio * cantidad - nuevo_descuento
+        nuevas_ganancias = nuevos_ingresos - costo
+
+        actual = {'ventas': int(ingresos.sum()), 'ganancias': int(ganancia.sum())}
+        simulado = {'ventas': int(nuevos_ingresos.sum()), 'ganancias': int(nuevas_ganancias.sum())}
+        return {
+            'ventas_consideradas': int(v.sum()),
+            'actual': actual,
+            'simulado': simulado,
+            'diferencia': {k: simulado[k] - actual[k] for k in actual}
+        }
+
+    @staticmethod
+    def _mascara_periodo(periodos, desde, hasta):
+        mascara = np.ones(len(periodos), dtype=bool)
+        if desde:
+            mascara &= periodos >= desde
+        if hasta:
+            mascara &= periodos <= hasta
+        return mascara
@@ -8,27 +8,64 @@ Diseño optimizado para modo horizontal (Landscape)
 
 import os
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file
-from models import db, Producto, Produccion, Venta, Gasto, calcular_costo_unitario_mes, calcular_dinero_total, calcular_totales_mes, get_producciones_con_stock, get_dashboard_stats
+from functools import partial
+import click
+from flask import Flask, render_template, request, jsonify, send_file, g
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+from models import db, Producto, Produccion, Venta, Gasto, calcular_costo_unitario_mes, calcular_dinero_total, calcular_totales_mes, get_producciones_con_stock, get_dashboard_stats, auditar_stock, crear_indices, calcular_totales_rango, totales_por_periodo, filtro_fechas, GRANULARIDADES, totales_archivados, sumar_totales
+from backup import BackupError, crear_backup, listar_backups, restaurar_backup, estado_backup, iniciar_backup_en_segundo_plano
+from archivo import (ArchivoError, archivar_hasta, anios_archivados, anios_en_rango, resumen_archivo,
+                     totales_rango_archivados, series_archivadas, combinar_series, detalle_archivado,
+                     grupos_adjuntos, indexar_archivo)
+from busqueda import BusquedaNoDisponible, buscar, crear_fts, reconstruir_fts, TIPOS_BUSQUEDA
+from fabricas import FABRICA_PRINCIPAL, FabricaError, GestorFabricas
+from escritura import ColaEscritura, VENTANA_LOTE, TAMANIO_LOTE
 from fpdf import FPDF
 
+# NumPy es opcional: sin él la analítica columnar queda deshabilitada
+try:
+    from analitica import AnaliticaColumnar, codigo_periodo
+except ImportError:
+    AnaliticaColumnar = None
+
 # Configuración de rutas para portabilidad
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 DATABASE_DIR = os.path.join(BASE_DIR, 'database')
+DATABASE_PATH = os.path.join(DATABASE_DIR, 'fabrica.db')
+BACKUP_DIR = os.path.join(DATABASE_DIR, 'backups')
+FABRICAS_DIR = os.path.join(DATABASE_DIR, 'fabricas')
+ARCHIVO_DIR = os.path.join(DATABASE_DIR, 'archivo')
 
 # Asegurar directorios
 os.makedirs(DATABASE_DIR, exist_ok=True)
 
 app = Flask(__name__, template_folder=TEMPLATE_DIR, static_folder=STATIC_DIR)
 app.config['SECRET_KEY'] = 'factory-app-secret-2024'
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(DATABASE_DIR, "fabrica.db")}'
+app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DATABASE_PATH}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Escritura agrupada (group commit): un hilo escritor por base de datos
+app.config['ESCRITURA_AGRUPADA'] = os.environ.get('FABRICA_ESCRITURA_AGRUPADA', '0') == '1'
+app.config['ESCRITURA_VENTANA'] = float(os.environ.get('FABRICA_ESCRITURA_VENTANA', VENTANA_LOTE))
+app.config['ESCRITURA_TAMANIO_LOTE'] = int(os.environ.get('FABRICA_ESCRITURA_LOTE', TAMANIO_LOTE))
+
 db.init_app(app)
 
+fabricas = GestorFabricas(FABRICAS_DIR, DATABASE_PATH)
+
+# Un snapshot de analítica por fábrica; se descarta al cerrar su base
+analiticas = {}
+fabricas.al_cerrar.append(lambda clave: analiticas.pop(clave, None))
+
+colas_escritura = {}
+colas_lock = threading.Lock()
+
 
 # ============================================================================
 # UTILIDADES
@@ -41,6 +78,11 @@ def format_guaranies(valor):
     return f"Gs. {valor:,.0f}".replace(",", ".")
 
 
+def format_fecha(iso):
+    """Fecha ISO (como la devuelve to_dict) en formato dd/mm/aaaa"""
+    return datetime.fromisoformat(iso).strftime('%d/%m/%Y') if iso else ''
+
+
 def get_mes_nombre(mes_num):
     """Devuelve el nombre del mes en español"""
     meses = ['', 'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
@@ -48,6 +90,175 @@ def get_mes_nombre(mes_num):
     return meses[mes_num] if 1 <= mes_num <= 12 else ''
 
 
+def parse_fecha(valor):
+    """Convierte 'YYYY-MM-DD' en date; None si viene vacío"""
+    if not valor:
+        return None
+    return datetime.strptime(valor, '%Y-%m-%d').date()
+
+
+def get_parametros_reporte():
+    """Lee mes/anio o desde/hasta/granularidad de la query string"""
+    try:
+        desde = parse_fecha(request.args.get('desde'))
+        hasta = parse_fecha(request.args.get('hasta'))
+    except ValueError:
+        raise ValueError('Fecha inválida, use el formato AAAA-MM-DD')
+    
+    if desde and hasta and desde > hasta:
+        raise ValueError('La fecha desde es posterior a hasta')
+    
+    granularidad = request.args.get('granularidad', 'mes')
+    if granularidad not in GRANULARIDADES:
+        raise ValueError(f'Granularidad inválida: use {", ".join(GRANULARIDADES)}')
+    
+    return {
+        'mes': request.args.get('mes', type=int),
+        'anio': request.args.get('anio', type=int),
+        'desde': desde,
+        'hasta': hasta,
+        'granularidad': granularidad
+    }
+
+
+def get_filtros_periodo(mes, anio, desde=None, hasta=None):
+    """Filtros de Venta y Gasto para el período pedido"""
+    if desde or hasta:
+        # Rango de fechas sobre las columnas indexadas
+        return filtro_fechas(Venta.fecha, desde, hasta), filtro_fechas(Gasto.fecha, desde, hasta)
+    
+    filtros_venta = []
+    filtros_gasto = []
+    if mes:
+        filtros_venta.append(Venta.mes_venta == mes)
+        filtros_gasto.append(Gasto.mes_gasto == mes)
+    if anio:
+        filtros_venta.append(Venta.anio_venta == anio)
+        filtros_gasto.append(Gasto.anio_gasto == anio)
+    return filtros_venta, filtros_gasto
+
+
+def get_engine_actual():
+    """Engine de la fábrica del request actual"""
+    return g.get('engine_fabrica') or db.engine
+
+
+def get_ruta_db():
+    """Archivo SQLite de la fábrica del request actual"""
+    return fabricas.ruta_db(g.get('fabrica', FABRICA_PRINCIPAL))
+
+
+def get_backup_dir():
+    """Carpeta de respaldos de la fábrica del request actual"""
+    clave = g.get('fabrica', FABRICA_PRINCIPAL)
+    if clave == FABRICA_PRINCIPAL:
+        return BACKUP_DIR
+    return os.path.join(BACKUP_DIR, clave)
+
+
+def get_archivo_dir():
+    """Carpeta de archivos anuales de la fábrica del request actual"""
+    clave = g.get('fabrica', FABRICA_PRINCIPAL)
+    if clave == FABRICA_PRINCIPAL:
+        return ARCHIVO_DIR
+    return os.path.join(ARCHIVO_DIR, clave)
+
+
+def error_anio_archivado(anio):
+    """Error (payload, status) si el año ya fue archivado (no admite cambios)"""
+    if anio in anios_archivados():
+        return {
+            'success': False,
+            'error': f'El año {anio} está archivado y no admite nuevos registros'
+        }, 400
+    return None
+
+
+def get_cola_escritura():
+    """Cola de escritura agrupada de la fábrica actual (None si está desactivada)"""
+    if not app.config['ESCRITURA_AGRUPADA']:
+        return None
+    clave = g.get('fabrica', FABRICA_PRINCIPAL)
+    with colas_lock:
+        if clave not in colas_escritura:
+            colas_escritura[clave] = ColaEscritura(
+                app,
+                lambda: usar_fabrica(clave),
+                ventana=app.config['ESCRITURA_VENTANA'],
+                tamanio_lote=app.config['ESCRITURA_TAMANIO_LOTE'],
+                nombre=f'escritor-{clave}'
+            )
+        return colas_escritura[clave]
+
+
+def responder_escritura(funcion, *args):
+    """Ejecuta una escritura (payload, status) directo o por la cola agrupada"""
+    cola = get_cola_escritura()
+    if cola:
+        payload, status = cola.ejecutar(funcion, *args)
+    else:
+        try:
+            payload, status = funcion(*args)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return jsonify(payload), status
+
+
+def get_analitica():
+    """Snapshot de analítica de la fábrica actual (None sin NumPy)"""
+    if AnaliticaColumnar is None:
+        return None
+    clave = g.get('fabrica', FABRICA_PRINCIPAL)
+    if clave not in analiticas:
+        analiticas[clave] = AnaliticaColumnar()
+    return analiticas[clave]
+
+
+def invalidar_analitica(tabla):
+    """Fuerza la recarga de una tabla en la analítica tras un borrado"""
+    analitica = analiticas.get(g.get('fabrica', FABRICA_PRINCIPAL))
+    if analitica:
+        analitica.invalidar(tabla)
+
+
+def usar_fabrica(clave):
+    """Enruta la sesión del contexto actual a la base de una fábrica"""
+    g.fabrica = clave
+    if clave != FABRICA_PRINCIPAL:
+        g.engine_fabrica = fabricas.engine(clave)
+
+
+@app.before_request
+def seleccionar_fabrica():
+    """Enruta el request a la base de su fábrica (header, parámetro o cookie)"""
+    clave = (request.headers.get('X-Fabrica') or request.args.get('fabrica')
+             or request.cookies.get('fabrica') or FABRICA_PRINCIPAL)
+    
+    try:
+        usar_fabrica(clave)
+    except FabricaError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    
+    fabricas.cerrar_inactivas()
+
+
+@app.errorhandler(OperationalError)
+def base_ocupada(e):
+    """Base bloqueada por otro escritor: 503 con el código de SQLite para reintentar
+
+    Los demás errores de SQLite siguen como error interno.
+    """
+    if 'database is locked' not in str(e.orig):
+        raise e
+    return jsonify({
+        'success': False,
+        'error': str(e.orig),
+        'codigo': getattr(e.orig, 'sqlite_errorname', 'SQLITE_BUSY')
+    }), 503
+
+
 # ============================================================================
 # RUTAS PRINCIPALES
 # ============================================================================
@@ -101,52 +312,76 @@ def api_productos_list():
 @app.route('/api/productos', methods=['POST'])
 def api_producto_create():
     """Crear nuevo producto"""
-    data = request.get_json()
-    
+    return responder_escritura(crear_producto, request.get_json())
+
+
+def crear_producto(data):
+    """Crea un producto (sin commit); devuelve (payload, status)"""
+    stock_inicial = data.get('stock_inicial') or 0
     producto = Producto(
         nombre=data.get('nombre'),
-        stock_actual=data.get('stock_inicial', 0),
+        stock_actual=stock_inicial,
         precio_mayorista=data.get('precio_mayorista', 0),
         precio_minorista=data.get('precio_minorista', 0)
     )
     
     db.session.add(producto)
-    db.session.commit()
-    
-    return jsonify({'success': True, 'producto': producto.to_dict()})
+    db.session.flush()
+    
+    if stock_inicial > 0:
+        # El stock inicial es un lote más: la auditoría lo cuenta y se puede vender
+        ahora = datetime.now()
+        db.session.add(Produccion(
+            producto_id=producto.id,
+            cantidad=stock_inicial,
+            mes=ahora.month,
+            anio=ahora.year,
+            costo_unitario_calculado=calcular_costo_unitario_mes(ahora.month, ahora.year)
+        ))
+        db.session.flush()
+    
+    return {'success': True, 'producto': producto.to_dict()}, 200
 
 
 @app.route('/api/productos/<int:id>', methods=['PUT'])
 def api_producto_update(id):
     """Actualizar producto"""
+    return responder_escritura(actualizar_producto, id, request.get_json())
+
+
+def actualizar_producto(id, data):
+    """Actualiza nombre y precios de un producto (sin commit); devuelve (payload, status)"""
     producto = Producto.query.get_or_404(id)
-    data = request.get_json()
     
     producto.nombre = data.get('nombre', producto.nombre)
     producto.precio_mayorista = data.get('precio_mayorista', producto.precio_mayorista)
     producto.precio_minorista = data.get('precio_minorista', producto.precio_minorista)
     
-    db.session.commit()
+    db.session.flush()
     
-    return jsonify({'success': True, 'producto': producto.to_dict()})
+    return {'success': True, 'producto': producto.to_dict()}, 200
 
 
 @app.route('/api/productos/<int:id>', methods=['DELETE'])
 def api_producto_delete(id):
     """Eliminar producto (soft delete)"""
+    return responder_escritura(eliminar_producto, id)
+
+
+def eliminar_producto(id):
+    """Da de baja un producto sin movimientos (sin commit); devuelve (payload, status)"""
     producto = Producto.query.get_or_404(id)
     
     # Verificar si tiene producciones o ventas
     if producto.producciones or producto.ventas:
-        return jsonify({
+        return {
             'success': False,
             'error': 'No se puede eliminar: tiene producciones o ventas asociadas'
-        }), 400
+        }, 400
     
     producto.activo = False
-    db.session.commit()
     
-    return jsonify({'success': True})
+    return {'success': True}, 200
 
 
 # ============================================================================
@@ -166,11 +401,18 @@ def api_produccion_list():
 @app.route('/api/produccion', methods=['POST'])
 def api_produccion_create():
     """Crear nueva producción"""
-    data = request.get_json()
-    
+    return responder_escritura(registrar_produccion, request.get_json())
+
+
+def registrar_produccion(data):
+    """Registra una producción y suma su stock (sin commit); devuelve (payload, status)"""
     mes = data.get('mes')
     anio = data.get('anio')
     
+    error = error_anio_archivado(anio)
+    if error:
+        return error
+    
     # Calcular costo unitario para este mes
     costo_unitario = calcular_costo_unitario_mes(mes, anio)
     
@@ -188,35 +430,40 @@ def api_produccion_create():
     producto = Producto.query.get(data.get('producto_id'))
     producto.stock_actual += data.get('cantidad')
     
-    db.session.commit()
+    db.session.flush()
     
-    return jsonify({
+    return {
         'success': True,
         'produccion': produccion.to_dict(),
         'costo_unitario': costo_unitario
-    })
+    }, 200
 
 
 @app.route('/api/produccion/<int:id>', methods=['DELETE'])
 def api_produccion_delete(id):
     """Eliminar producción"""
+    return responder_escritura(eliminar_produccion, id)
+
+
+def eliminar_produccion(id):
+    """Elimina una producción sin ventas y resta su stock (sin commit); devuelve (payload, status)"""
     produccion = Produccion.query.get_or_404(id)
     
     # Verificar si tiene ventas asociadas
     if produccion.ventas:
-        return jsonify({
+        return {
             'success': False,
             'error': 'No se puede eliminar: tiene ventas asociadas'
-        }), 400
+        }, 400
     
     # Restar del stock
     producto = Producto.query.get(produccion.producto_id)
     producto.stock_actual -= produccion.cantidad
     
     db.session.delete(produccion)
-    db.session.commit()
+    invalidar_analitica('produccion')
     
-    return jsonify({'success': True})
+    return {'success': True}, 200
 
 
 @app.route('/api/productos/<int:producto_id>/producciones-disponibles')
@@ -240,8 +487,11 @@ def api_ventas_list():
 @app.route('/api/ventas', methods=['POST'])
 def api_venta_create():
     """Crear nueva venta"""
-    data = request.get_json()
-    
+    return responder_escritura(registrar_venta, request.get_json())
+
+
+def registrar_venta(data):
+    """Registra una venta de un lote y descuenta el stock (sin commit); devuelve (payload, status)"""
     producto_id = data.get('producto_id')
     produccion_id = data.get('produccion_id')
     cantidad = data.get('cantidad')
@@ -260,16 +510,16 @@ def api_venta_create():
     disponible = produccion.cantidad - vendido
     
     if cantidad > disponible:
-        return jsonify({
+        return {
             'success': False,
             'error': f'Stock insuficiente. Solo hay {disponible} unidades disponibles'
-        }), 400
+        }, 400
     
     if cantidad > producto.stock_actual:
-        return jsonify({
+        return {
             'success': False,
             'error': 'Stock insuficiente en el producto'
-        }), 400
+        }, 400
     
     # Determinar precio aplicado
     if tipo_precio == 'mayorista':
@@ -302,18 +552,23 @@ def api_venta_create():
     # Actualizar stock
     producto.stock_actual -= cantidad
     
-    db.session.commit()
+    db.session.flush()
     
-    return jsonify({
+    return {
         'success': True,
         'venta': venta.to_dict(),
         'ganancia_real': ganancia_real
-    })
+    }, 200
 
 
 @app.route('/api/ventas/<int:id>', methods=['DELETE'])
 def api_venta_delete(id):
     """Eliminar venta"""
+    return responder_escritura(eliminar_venta, id)
+
+
+def eliminar_venta(id):
+    """Elimina una venta y devuelve el stock (sin commit); devuelve (payload, status)"""
     venta = Venta.query.get_or_404(id)
     
     # Devolver stock al producto
@@ -321,9 +576,9 @@ def api_venta_delete(id):
     producto.stock_actual += venta.cantidad
     
     db.session.delete(venta)
-    db.session.commit()
+    invalidar_analitica('ventas')
     
-    return jsonify({'success': True})
+    return {'success': True}, 200
 
 
 # ============================================================================
@@ -340,7 +595,14 @@ def api_gastos_list():
 @app.route('/api/gastos', methods=['POST'])
 def api_gasto_create():
     """Crear nuevo gasto"""
-    data = request.get_json()
+    return responder_escritura(registrar_gasto, request.get_json())
+
+
+def registrar_gasto(data):
+    """Registra un gasto (sin commit); devuelve (payload, status)"""
+    error = error_anio_archivado(data.get('anio'))
+    if error:
+        return error
     
     gasto = Gasto(
         concepto=data.get('concepto'),
@@ -351,19 +613,24 @@ def api_gasto_create():
     )
     
     db.session.add(gasto)
-    db.session.commit()
+    db.session.flush()
     
-    return jsonify({'success': True, 'gasto': gasto.to_dict()})
+    return {'success': True, 'gasto': gasto.to_dict()}, 200
 
 
 @app.route('/api/gastos/<int:id>', methods=['DELETE'])
 def api_gasto_delete(id):
     """Eliminar gasto"""
+    return responder_escritura(eliminar_gasto, id)
+
+
+def eliminar_gasto(id):
+    """Elimina un gasto (sin commit); devuelve (payload, status)"""
     gasto = Gasto.query.get_or_404(id)
     db.session.delete(gasto)
-    db.session.commit()
+    invalidar_analitica('gastos')
     
-    return jsonify({'success': True})
+    return {'success': True}, 200
 
 
 @app.route('/api/gastos/totales')
@@ -372,6 +639,11 @@ def api_gastos_totales():
     total_fabrica = db.session.query(func.sum(Gasto.monto)).filter_by(tipo='Fabrica').scalar() or 0
     total_personal = db.session.query(func.sum(Gasto.monto)).filter_by(tipo='Personal').scalar() or 0
     
+    # Años archivados desde sus resúmenes
+    archivado = totales_archivados()
+    total_fabrica += archivado['gastos_fabrica']
+    total_personal += archivado['gastos_personal']
+    
     return jsonify({
         'fabrica': total_fabrica,
         'personal': total_personal,
@@ -385,42 +657,66 @@ def api_gastos_totales():
 
 @app.route('/api/reportes/datos')
 def api_reportes_datos():
-    """Obtener datos para reportes"""
-    mes = request.args.get('mes', type=int)
-    anio = request.args.get('anio', type=int)
-    
-    # Query base
-    ventas_query = Venta.query
-    gastos_query = Gasto.query
-    
-    if mes:
-        ventas_query = ventas_query.filter_by(mes_venta=mes)
-        gastos_query = gastos_query.filter_by(mes_gasto=mes)
-    
-    if anio:
-        ventas_query = ventas_query.filter_by(anio_venta=anio)
-        gastos_query = gastos_query.filter_by(anio_gasto=anio)
-    
-    ventas = ventas_query.order_by(Venta.fecha.desc()).all()
-    gastos = gastos_query.order_by(Gasto.fecha.desc()).all()
+    """Obtener datos para reportes (por mes/año o por rango de fechas)"""
+    try:
+        params = get_parametros_reporte()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    mes, anio = params['mes'], params['anio']
+    desde, hasta = params['desde'], params['hasta']
+    filtros_venta, filtros_gasto = get_filtros_periodo(mes, anio, desde, hasta)
+    
+    ventas = [v.to_dict() for v in Venta.query.filter(*filtros_venta).order_by(Venta.fecha.desc()).all()]
+    gastos = [g.to_dict() for g in Gasto.query.filter(*filtros_gasto).order_by(Gasto.fecha.desc()).all()]
+    
+    # Movimientos de años archivados, solo si el período los alcanza
+    ventas_archivadas, gastos_archivados = detalle_archivado(get_archivo_dir(), mes, anio, desde, hasta)
+    for fila in ventas_archivadas + gastos_archivados:
+        fila['fecha'] = fila['fecha'].isoformat() if fila['fecha'] else None
+    ventas += ventas_archivadas
+    gastos += gastos_archivados
     
     # Calcular totales
-    totales = calcular_totales_mes(mes or datetime.now().month, anio or datetime.now().year)
+    if desde or hasta:
+        totales = calcular_totales_rango(desde, hasta)
+        series = totales_por_periodo(desde, hasta, params['granularidad'])
+        if anios_en_rango(desde, hasta):
+            totales = sumar_totales(totales, totales_rango_archivados(desde, hasta, get_archivo_dir()))
+            series = combinar_series(series, series_archivadas(
+                desde, hasta, params['granularidad'], get_archivo_dir()))
+    else:
+        totales = calcular_totales_mes(mes or datetime.now().month, anio or datetime.now().year)
+        series = None
     
     return jsonify({
-        'ventas': [v.to_dict() for v in ventas],
-        'gastos': [g.to_dict() for g in gastos],
+        'ventas': ventas,
+        'gastos': gastos,
         'totales': totales,
+        'series': series,
         'mes': mes,
-        'anio': anio
+        'anio': anio,
+        'desde': desde.isoformat() if desde else None,
+        'hasta': hasta.isoformat() if hasta else None,
+        'granularidad': params['granularidad']
     })
 
 
 @app.route('/api/reportes/pdf')
 def api_generar_pdf():
     """Generar reporte PDF usando FPDF2"""
-    mes = request.args.get('mes', type=int)
-    anio = request.args.get('anio', type=int)
+    try:
+        params = get_parametros_reporte()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    mes, anio = params['mes'], params['anio']
+    desde, hasta = params['desde'], params['hasta']
+    es_rango = bool(desde or hasta)
+    if not es_rango and not anio:
+        # Sin año, el mes solo no delimita período: reporte general
+        mes = None
+    filtros_venta, filtros_gasto = get_filtros_periodo(mes, anio, desde, hasta)
     
     # Crear PDF en memoria
     pdf = FPDF(orientation='L', unit='mm', format='A4')  # Landscape
@@ -436,7 +732,11 @@ def api_generar_pdf():
     
     # Subtítulo
     pdf.set_font(font_family, '', 14)
-    if mes and anio:
+    if es_rango:
+        texto_desde = desde.strftime('%d/%m/%Y') if desde else 'inicio'
+        texto_hasta = hasta.strftime('%d/%m/%Y') if hasta else 'hoy'
+        pdf.cell(0, 8, f'Del {texto_desde} al {texto_hasta}', ln=True, align='C')
+    elif mes and anio:
         pdf.cell(0, 8, f'{get_mes_nombre(mes)} {anio}', ln=True, align='C')
     elif anio:
         pdf.cell(0, 8, f'Año {anio}', ln=True, align='C')
@@ -453,21 +753,10 @@ def api_generar_pdf():
     # Calcular totales
     ventas_query = db.session.query(func.sum(
         Venta.precio_aplicado * Venta.cantidad - Venta.descuento
-    ))
-    gastos_fabrica_query = db.session.query(func.sum(Gasto.monto)).filter(Gasto.tipo == 'Fabrica')
-    gastos_personal_query = db.session.query(func.sum(Gasto.monto)).filter(Gasto.tipo == 'Personal')
-    ganancias_query = db.session.query(func.sum(Venta.ganancia_real))
-    
-    if mes and anio:
-        ventas_query = ventas_query.filter(Venta.mes_venta == mes, Venta.anio_venta == anio)
-        gastos_fabrica_query = gastos_fabrica_query.filter(Gasto.mes_gasto == mes, Gasto.anio_gasto == anio)
-        gastos_personal_query = gastos_personal_query.filter(Gasto.mes_gasto == mes, Gasto.anio_gasto == anio)
-        ganancias_query = ganancias_query.filter(Venta.mes_venta == mes, Venta.anio_venta == anio)
-    elif anio:
-        ventas_query = ventas_query.filter(Venta.anio_venta == anio)
-        gastos_fabrica_query = gastos_fabrica_query.filter(Gasto.anio_gasto == anio)
-        gastos_personal_query = gastos_personal_query.filter(Gasto.anio_gasto == anio)
-        ganancias_query = ganancias_query.filter(Venta.anio_venta == anio)
+    )).filter(*filtros_venta)
+    gastos_fabrica_query = db.session.query(func.sum(Gasto.monto)).filter(Gasto.tipo == 'Fabrica', *filtros_gasto)
+    gastos_personal_query = db.session.query(func.sum(Gasto.monto)).filter(Gasto.tipo == 'Personal', *filtros_gasto)
+    ganancias_query = db.session.query(func.sum(Venta.ganancia_real)).filter(*filtros_venta)
     
     total_ventas = ventas_query.scalar() or 0
     total_gastos_fabrica = gastos_fabrica_query.scalar() or 0
@@ -475,6 +764,29 @@ def api_generar_pdf():
     total_gastos = total_gastos_fabrica + total_gastos_personal
     total_ganancias = ganancias_query.scalar() or 0
     
+    # Sumar años archivados: resúmenes guardados o ATTACH si es un rango
+    if es_rango:
+        archivado = (totales_rango_archivados(desde, hasta, get_archivo_dir())
+                     if anios_en_rango(desde, hasta) else None)
+    else:
+        archivado = totales_archivados(mes, anio)
+    if archivado:
+        total_ventas += archivado['ventas']
+        total_gastos_fabrica += archivado['gastos_fabrica']
+        total_gastos_personal += archivado['gastos_personal']
+        total_gastos += archivado['gastos_total']
+        total_ganancias += archivado['ganancias']
+    
+    # Detalle (hasta 50 filas), incluyendo años archivados del período
+    ventas = [v.to_dict() for v in Venta.query.filter(*filtros_venta).order_by(Venta.fecha.desc()).limit(50).all()]
+    gastos = [g.to_dict() for g in Gasto.query.filter(*filtros_gasto).order_by(Gasto.fecha.desc()).limit(50).all()]
+    ventas_archivadas, gastos_archivados = detalle_archivado(
+        get_archivo_dir(), mes, anio, desde, hasta, limite=50)
+    for fila in ventas_archivadas + gastos_archivados:
+        fila['fecha'] = fila['fecha'].isoformat() if fila['fecha'] else None
+    ventas = sorted(ventas + ventas_archivadas, key=lambda v: v['fecha'] or '', reverse=True)[:50]
+    gastos = sorted(gastos + gastos_archivados, key=lambda g: g['fecha'] or '', reverse=True)[:50]
+    
     # SECCIÓN: RESUMEN FINANCIERO
     pdf.set_font(font_family, 'B', 14)
     pdf.set_fill_color(50, 50, 50)
@@ -500,6 +812,44 @@ def api_generar_pdf():
     
     pdf.ln(5)
     
+    # SECCIÓN: EVOLUCIÓN POR PERÍODO (solo reportes por rango)
+    if es_rango:
+        series = totales_por_periodo(desde, hasta, params['granularidad'])
+        if anios_en_rango(desde, hasta):
+            series = combinar_series(series, series_archivadas(
+                desde, hasta, params['granularidad'], get_archivo_dir()))
+        
+        pdf.set_font(font_family, 'B', 14)
+        pdf.set_fill_color(50, 50, 50)
+        pdf.set_text_color(255, 255, 255)
+        pdf.cell(0, 10, 'Evolucion por Periodo', ln=True, fill=True)
+        pdf.set_text_color(0, 0, 0)
+        pdf.ln(3)
+        
+        if series:
+            pdf.set_font(font_family, 'B', 10)
+            pdf.set_fill_color(220, 220, 220)
+            pdf.cell(35, 7, 'Periodo', fill=True)
+            pdf.cell(45, 7, 'Ventas', align='R', fill=True)
+            pdf.cell(45, 7, 'Gastos', align='R', fill=True)
+            pdf.cell(45, 7, 'Ganancia', align='R', fill=True)
+            pdf.cell(45, 7, 'Balance', align='R', fill=True)
+            pdf.ln()
+            
+            pdf.set_font(font_family, '', 9)
+            for fila in series:
+                pdf.cell(35, 6, fila['periodo'])
+                pdf.cell(45, 6, format_guaranies(fila['ventas']), align='R')
+                pdf.cell(45, 6, format_guaranies(fila['gastos_total']), align='R')
+                pdf.cell(45, 6, format_guaranies(fila['ganancias']), align='R')
+                pdf.cell(45, 6, format_guaranies(fila['balance']), align='R')
+                pdf.ln()
+        else:
+            pdf.set_font(font_family, '', 11)
+            pdf.cell(0, 7, 'No hay movimientos en el rango', ln=True)
+        
+        pdf.ln(5)
+    
     # SECCIÓN: VENTAS DETALLADAS
     pdf.set_font(font_family, 'B', 14)
     pdf.set_fill_color(50, 50, 50)
@@ -508,13 +858,6 @@ def api_generar_pdf():
     pdf.set_text_color(0, 0, 0)
     pdf.ln(3)
     
-    ventas_query = Venta.query
-    if mes and anio:
-        ventas_query = ventas_query.filter(Venta.mes_venta == mes, Venta.anio_venta == anio)
-    elif anio:
-        ventas_query = ventas_query.filter(Venta.anio_venta == anio)
-    ventas = ventas_query.order_by(Venta.fecha.desc()).limit(50).all()
-    
     if ventas:
         # Encabezados
         pdf.set_font(font_family, 'B', 10)
@@ -531,14 +874,14 @@ def api_generar_pdf():
         # Datos
         pdf.set_font(font_family, '', 9)
         for venta in ventas:
-            pdf.cell(30, 6, venta.fecha.strftime('%d/%m/%Y'))
-            pdf.cell(60, 6, venta.producto.nombre[:30])
-            pdf.cell(25, 6, str(venta.cantidad), align='C')
-            pdf.cell(35, 6, format_guaranies(venta.precio_aplicado), align='R')
-            pdf.cell(35, 6, format_guaranies(venta.descuento), align='R')
-            total = (venta.precio_aplicado * venta.cantidad) - venta.descuento
+            pdf.cell(30, 6, format_fecha(venta['fecha']))
+            pdf.cell(60, 6, (venta['producto_nombre'] or '')[:30])
+            pdf.cell(25, 6, str(venta['cantidad']), align='C')
+            pdf.cell(35, 6, format_guaranies(venta['precio_aplicado']), align='R')
+            pdf.cell(35, 6, format_guaranies(venta['descuento']), align='R')
+            total = (venta['precio_aplicado'] * venta['cantidad']) - (venta['descuento'] or 0)
             pdf.cell(35, 6, format_guaranies(total), align='R')
-            pdf.cell(35, 6, format_guaranies(venta.ganancia_real), align='R')
+            pdf.cell(35, 6, format_guaranies(venta['ganancia_real']), align='R')
             pdf.ln()
         
         # Total
@@ -564,13 +907,6 @@ def api_generar_pdf():
     pdf.set_text_color(0, 0, 0)
     pdf.ln(3)
     
-    gastos_query = Gasto.query
-    if mes and anio:
-        gastos_query = gastos_query.filter(Gasto.mes_gasto == mes, Gasto.anio_gasto == anio)
-    elif anio:
-        gastos_query = gastos_query.filter(Gasto.anio_gasto == anio)
-    gastos = gastos_query.order_by(Gasto.fecha.desc()).limit(50).all()
-    
     if gastos:
         # Encabezados
         pdf.set_font(font_family, 'B', 10)
@@ -584,10 +920,10 @@ def api_generar_pdf():
         # Datos
         pdf.set_font(font_family, '', 9)
         for gasto in gastos:
-            pdf.cell(30, 6, gasto.fecha.strftime('%d/%m/%Y'))
-            pdf.cell(80, 6, gasto.concepto[:40])
-            pdf.cell(30, 6, gasto.tipo, align='C')
-            pdf.cell(40, 6, format_guaranies(gasto.monto), align='R')
+            pdf.cell(30, 6, format_fecha(gasto['fecha']))
+            pdf.cell(80, 6, gasto['concepto'][:40])
+            pdf.cell(30, 6, gasto['tipo'], align='C')
+            pdf.cell(40, 6, format_guaranies(gasto['monto']), align='R')
             pdf.ln()
         
         # Totales
@@ -611,7 +947,9 @@ def api_generar_pdf():
     pdf_buffer.seek(0)
     
     # Nombre del archivo
-    if mes and anio:
+    if es_rango:
+        filename = f'reporte_{desde or "inicio"}_{hasta or "hoy"}.pdf'
+    elif mes and anio:
         filename = f'reporte_{get_mes_nombre(mes).lower()}_{anio}.pdf'
     elif anio:
         filename = f'reporte_{anio}.pdf'
@@ -626,20 +964,381 @@ def api_generar_pdf():
     )
 
 
+# ============================================================================
+# API - ANALÍTICA (NumPy)
+# ============================================================================
+
+def parse_periodo(valor):
+    """Convierte un período 'AAAA-MM' en entero AAAAMM; None si viene vacío"""
+    if not valor:
+        return None
+    anio, mes = valor.split('-')
+    return codigo_periodo(int(mes), int(anio))
+
+
+def get_periodo_arg(nombre):
+    """Lee un período 'AAAA-MM' de la query string"""
+    return parse_periodo(request.args.get(nombre))
+
+
+def preparar_analitica():
+    """Refresca el snapshot columnar; devuelve un error JSON si no hay NumPy"""
+    analitica = get_analitica()
+    if analitica is None:
+        return jsonify({
+            'success': False,
+            'error': 'Analítica no disponible: instale numpy'
+        }), 503
+    analitica.refrescar()
+    return None
+
+
+@app.route('/api/analitica/periodos')
+def api_analitica_periodos():
+    """Totales por mes calculados en memoria (desde/hasta: AAAA-MM)"""
+    error = preparar_analitica()
+    if error:
+        return error
+    try:
+        desde, hasta = get_periodo_arg('desde'), get_periodo_arg('hasta')
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Período inválido, use AAAA-MM'}), 400
+    
+    return jsonify({
+        'filas': get_analitica().filas(),
+        'periodos': get_analitica().totales_por_periodo(desde, hasta)
+    })
+
+
+@app.route('/api/analitica/mes')
+def api_analitica_mes():
+    """Totales de un mes calculados en memoria (mes, anio; por defecto el actual)"""
+    error = preparar_analitica()
+    if error:
+        return error
+    mes = request.args.get('mes', datetime.now().month, type=int)
+    anio = request.args.get('anio', datetime.now().year, type=int)
+    
+    return jsonify(get_analitica().totales_mes(mes, anio))
+
+
+@app.route('/api/analitica/productos')
+def api_analitica_productos():
+    """Unidades, ventas y ganancia por producto (desde/hasta: AAAA-MM)"""
+    error = preparar_analitica()
+    if error:
+        return error
+    try:
+        desde, hasta = get_periodo_arg('desde'), get_periodo_arg('hasta')
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Período inválido, use AAAA-MM'}), 400
+    
+    return jsonify(get_analitica().totales_por_producto(desde, hasta))
+
+
+@app.route('/api/analitica/simular', methods=['POST'])
+def api_analitica_simular():
+    """Simular el impacto de cambios de precio o descuento"""
+    error = preparar_analitica()
+    if error:
+        return error
+    data = request.get_json() or {}
+    
+    try:
+        resultado = get_analitica().simular(
+            precios=data.get('precios'),
+            factor_precio=float(data.get('factor_precio', 1.0)),
+            factor_descuento=float(data.get('factor_descuento', 1.0)),
+            desde=parse_periodo(data.get('desde')),
+            hasta=parse_periodo(data.get('hasta'))
+        )
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Parámetros de simulación inválidos'}), 400
+    
+    return jsonify({'success': True, **resultado})
+
+
+# ============================================================================
+# API - BÚSQUEDA
+# ============================================================================
+
+@app.route('/api/buscar')
+def api_buscar():
+    """Buscar productos, gastos y ventas por texto (prefijos, por relevancia)"""
+    q = request.args.get('q', '').strip()
+    tipo = request.args.get('tipo')
+    if tipo and tipo not in TIPOS_BUSQUEDA:
+        return jsonify({
+            'success': False,
+            'error': f'Tipo inválido: use {", ".join(TIPOS_BUSQUEDA)}'
+        }), 400
+    
+    try:
+        # Los gastos y ventas de años archivados se buscan en sus archivos
+        resultado = buscar(
+            q,
+            tipos=(tipo,) if tipo else TIPOS_BUSQUEDA,
+            pagina=request.args.get('pagina', 1, type=int),
+            por_pagina=request.args.get('por_pagina', 20, type=int),
+            archivos=partial(grupos_adjuntos, anios_archivados(), get_archivo_dir())
+        )
+    except (BusquedaNoDisponible, ArchivoError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    
+    return jsonify(resultado)
+
+
+@app.cli.command('reconstruir-busqueda')
+@click.option('--fabrica', default=FABRICA_PRINCIPAL, help='Clave de la fábrica')
+def cli_reconstruir_busqueda(fabrica):
+    """Crear y reindexar las tablas de búsqueda FTS5"""
+    usar_fabrica(fabrica)
+    reconstruir_fts(get_engine_actual())
+    anios = indexar_archivo(get_archivo_dir())
+    print('Índice de búsqueda reconstruido' + (f' (archivo: {anios})' if anios else ''))
+
+
+# ============================================================================
+# API - AUDITORÍA DE STOCK
+# ============================================================================
+
+@app.route('/api/stock/auditoria')
+def api_stock_auditoria():
+    """Comparar stock_actual con producción - ventas (solo lectura)"""
+    return jsonify(auditar_stock())
+
+
+@app.route('/api/stock/reparar', methods=['POST'])
+def api_stock_reparar():
+    """Corregir stock_actual de los productos indicados (o de todos, confirmándolo)"""
+    data = request.get_json(silent=True) or {}
+    productos = data.get('productos')
+    if not productos and not data.get('todos'):
+        # Productos con stock inicial sin lote aparecen como discrepancia:
+        # la corrección se pide explícitamente para no pisarlo sin querer
+        return jsonify({
+            'success': False,
+            'error': 'Indique "productos" (lista de ids) o "todos": true'
+        }), 400
+    
+    return responder_escritura(reparar_stock_fabrica, productos or None)
+
+
+def reparar_stock_fabrica(productos):
+    """Audita y corrige el stock (sin commit); devuelve (payload, status)"""
+    return {'success': True, **auditar_stock(reparar=True, productos=productos)}, 200
+
+
+@app.cli.command('auditar-stock')
+@click.option('--reparar', is_flag=True, help='Corregir las discrepancias encontradas')
+@click.option('--fabrica', default=FABRICA_PRINCIPAL, help='Clave de la fábrica')
+def cli_auditar_stock(reparar, fabrica):
+    """Auditar (y opcionalmente reparar) el stock de los productos"""
+    usar_fabrica(fabrica)
+    resultado = auditar_stock(reparar=reparar)
+    db.session.commit()
+    for d in resultado['discrepancias']:
+        print(f"{d['nombre']}: actual {d['stock_actual']}, esperado {d['stock_esperado']}")
+    for lote in resultado['lotes_sobrevendidos']:
+        print(f"Lote {lote['produccion_id']} sobrevendido: {lote['vendido']}/{lote['cantidad']}")
+    print(f"{len(resultado['discrepancias'])} discrepancias"
+          + (' corregidas' if resultado['reparado'] else ''))
+
+
+# ============================================================================
+# API - RESPALDOS
+# ============================================================================
+
+@app.route('/api/backups', methods=['GET'])
+def api_backups_list():
+    """Listar respaldos y estado del respaldo en curso"""
+    return jsonify({
+        'backups': listar_backups(get_backup_dir()),
+        'estado': estado_backup(get_ruta_db())
+    })
+
+
+@app.route('/api/backups', methods=['POST'])
+def api_backup_create():
+    """Iniciar un respaldo en segundo plano (no bloquea las ventas)"""
+    if not iniciar_backup_en_segundo_plano(get_ruta_db(), get_backup_dir(),
+                                           archivo_dir=get_archivo_dir()):
+        return jsonify({
+            'success': False,
+            'error': 'Ya hay un respaldo en curso'
+        }), 409
+    
+    return jsonify({'success': True, 'estado': estado_backup(get_ruta_db())}), 202
+
+
+@app.route('/api/backups/<nombre>/restaurar', methods=['POST'])
+def api_backup_restore(nombre):
+    """Restaurar un respaldo sobre la base activa"""
+    try:
+        # Snapshot previo por si hay que deshacer la restauración
+        # (sin rotar, para no descartar el respaldo que se va a restaurar)
+        previo = crear_backup(get_ruta_db(), get_backup_dir(), etiqueta='pre-restauracion',
+                              conservar=None, archivo_dir=get_archivo_dir())
+        db.session.remove()
+        get_engine_actual().dispose()
+        resultado = restaurar_backup(nombre, get_ruta_db(), get_backup_dir(), archivo_dir=get_archivo_dir())
+        # El snapshot de analítica ya no corresponde a la base restaurada
+        analiticas.pop(g.get('fabrica', FABRICA_PRINCIPAL), None)
+    except BackupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    finally:
+        get_engine_actual().dispose()
+    
+    return jsonify({'success': True, 'resultado': resultado, 'backup_previo': previo['nombre']})
+
+
+@app.cli.command('backup')
+@click.option('--fabrica', default=FABRICA_PRINCIPAL, help='Clave de la fábrica')
+def cli_backup(fabrica):
+    """Crear un respaldo desde la línea de comandos"""
+    usar_fabrica(fabrica)
+    manifiesto = crear_backup(get_ruta_db(), get_backup_dir(), archivo_dir=get_archivo_dir())
+    print(f"Respaldo creado: {manifiesto['nombre']} ({manifiesto['tamanio']} bytes)")
+
+
+# ============================================================================
+# API - ARCHIVO HISTÓRICO
+# ============================================================================
+
+@app.route('/api/archivo', methods=['GET'])
+def api_archivo_list():
+    """Años archivados con sus totales"""
+    return jsonify(resumen_archivo())
+
+
+@app.route('/api/archivo', methods=['POST'])
+def api_archivo_create():
+    """Archivar los años cerrados hasta el año indicado (inclusive)"""
+    data = request.get_json() or {}
+    
+    try:
+        resultado = archivar_hasta(int(data.get('anio')), get_archivo_dir())
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Año inválido'}), 400
+    except ArchivoError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({'success': True, **resultado})
+
+
+@app.cli.command('archivar')
+@click.argument('anio', type=int)
+@click.option('--fabrica', default=FABRICA_PRINCIPAL, help='Clave de la fábrica')
+def cli_archivar(anio, fabrica):
+    """Mover al archivo los años cerrados hasta ANIO inclusive"""
+    usar_fabrica(fabrica)
+    resultado = archivar_hasta(anio, get_archivo_dir())
+    movidos = resultado['movidos']
+    print(f"Archivados {resultado['anios']}: {movidos['ventas']} ventas, "
+          f"{movidos['gastos']} gastos, {movidos['produccion']} producciones")
+
+
+# ============================================================================
+# API - ESCRITURA AGRUPADA
+# ============================================================================
+
+@app.route('/api/escritura/estado')
+def api_escritura_estado():
+    """Configuración y estadísticas de la escritura agrupada"""
+    return jsonify({
+        'activa': app.config['ESCRITURA_AGRUPADA'],
+        'ventana': app.config['ESCRITURA_VENTANA'],
+        'tamanio_lote': app.config['ESCRITURA_TAMANIO_LOTE'],
+        'colas': {clave: cola.estadisticas for clave, cola in colas_escritura.items()}
+    })
+
+
+# ============================================================================
+# API - FÁBRICAS
+# ============================================================================
+
+@app.route('/api/fabricas', methods=['GET'])
+def api_fabricas_list():
+    """Listar fábricas y bases abiertas en caché"""
+    return jsonify({
+        'fabricas': fabricas.listar(),
+        'abiertas': fabricas.abiertas(),
+        'actual': g.fabrica
+    })
+
+
+@app.route('/api/fabricas', methods=['POST'])
+def api_fabrica_create():
+    """Crear una fábrica nueva con su propia base de datos"""
+    data = request.get_json() or {}
+    
+    try:
+        fabricas.crear(data.get('clave'))
+    except FabricaError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({'success': True, 'clave': data.get('clave')})
+
+
+def get_totales_fabrica(clave):
+    """Estadísticas de una fábrica (se ejecuta en un hilo del pool)
+
+    Usa un engine propio, fuera de la caché: recorrer todas las fábricas
+    no debe desalojar ni cerrar los engines de los requests en curso.
+    """
+    with app.app_context():
+        g.fabrica = clave
+        engine = None
+        if clave != FABRICA_PRINCIPAL:
+            engine = g.engine_fabrica = fabricas.abrir(clave)
+        try:
+            return {'fabrica': clave, **get_dashboard_stats()}
+        finally:
+            db.session.remove()
+            if engine is not None:
+                engine.dispose()
+
+
+@app.route('/api/fabricas/consolidado')
+def api_fabricas_consolidado():
+    """Totales de todas las fábricas, consultadas en paralelo"""
+    claves = fabricas.listar()
+    if not claves:
+        return jsonify({'fabricas': [], 'consolidado': {}})
+    
+    with ThreadPoolExecutor(max_workers=min(4, len(claves))) as pool:
+        por_fabrica = list(pool.map(get_totales_fabrica, claves))
+    
+    consolidado = {
+        clave: sum(f[clave] for f in por_fabrica)
+        for clave in ('total_productos', 'total_produccion', 'total_ventas', 'dinero_total')
+    }
+    consolidado['totales_mes'] = {
+        clave: sum(f['totales_mes'][clave] for f in por_fabrica)
+        for clave in por_fabrica[0]['totales_mes']
+    }
+    
+    return jsonify({'fabricas': por_fabrica, 'consolidado': consolidado})
+
+
 # ============================================================================
 # INICIALIZACIÓN
 # ============================================================================
 
 @app.route('/api/init')
 def api_init():
-    """Inicializar base de datos"""
-    with app.app_context():
-        db.create_all()
+    """Inicializar base de datos de la fábrica actual"""
+    engine = get_engine_actual()
+    db.metadata.create_all(engine)
+    crear_indices(engine)
+    crear_fts(engine)
     return jsonify({'success': True, 'message': 'Base de datos inicializada'})
 
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        crear_indices()
+        crear_fts(db.engine)
     # Para desarrollo local
     app.run(debug=True, host='0.0.0.0', port=5000)
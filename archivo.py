@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Archivo Histórico - Sistema de Gestión de Fábrica
+Años cerrados movidos a bases SQLite anuales que se adjuntan (ATTACH) a demanda
+"""
+
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import create_engine, func
+
+from busqueda import ddl_tabla_fts
+from models import (db, Producto, Venta, Gasto, Produccion, ResumenArchivado, columnas_de,
+                    calcular_totales_rango, totales_por_periodo, filtro_fechas, sumar_totales)
+
+# Tablas que se copian a cada archivo anual
+TABLAS_ARCHIVO = [Venta.__table__, Gasto.__table__, Produccion.__table__, ResumenArchivado.__table__]
+
+# SQLite admite hasta 10 bases adjuntas por conexión (SQLITE_MAX_ATTACHED):
+# las consultas sobre muchos años los adjuntan por grupos de este tamaño
+MAX_ADJUNTOS = 10
+
+
+class ArchivoError(Exception):
+    """Año no archivable o archivo inexistente"""
+
+
+def ruta_archivo(directorio, anio):
+    return os.path.join(directorio, f'fabrica_{anio}.db')
+
+
+def esquema_archivo(anio):
+    return f'archivo_{anio}'
+
+
+def anios_archivados():
+    """Años con datos en el archivo, según resumen_archivado"""
+    filas = db.session.query(ResumenArchivado.anio).distinct().order_by(ResumenArchivado.anio).all()
+    return [anio for anio, in filas]
+
+
+def anios_en_rango(desde=None, hasta=None, anio=None):
+    """Años archivados que alcanza un período (mes/año o rango de fechas)"""
+    archivados = anios_archivados()
+    if anio:
+        return [a for a in archivados if a == anio]
+    return [a for a in archivados
+            if (not desde or a >= desde.year) and (not hasta or a <= hasta.year)]
+
+
+@contextmanager
+def adjuntar(anios, directorio):
+    """ATTACH de los archivos anuales en la conexión de la sesión actual"""
+    conn = db.session.connection()
+    esquemas = []
+    try:
+        for anio in anios:
+            ruta = ruta_archivo(directorio, anio)
+            if not os.path.exists(ruta):
+                raise ArchivoError(f'Falta el archivo del año {anio}')
+            conn.exec_driver_sql(f'ATTACH DATABASE ? AS {esquema_archivo(anio)}', (ruta,))
+            esquemas.append(esquema_archivo(anio))
+        yield esquemas
+    finally:
+        for esquema in esquemas:
+            conn.exec_driver_sql(f'DETACH DATABASE {esquema}')
+
+
+def grupos_adjuntos(anios, directorio, esquemas=None):
+    """Contextos adjuntar() de a MAX_ADJUNTOS años, para usar uno tras otro
+
+    Con `esquemas` solo se incluyen los años de esos esquemas.
+    """
+    if esquemas is not None:
+        anios = [a for a in anios if esquema_archivo(a) in esquemas]
+    return [adjuntar(anios[i:i + MAX_ADJUNTOS], directorio)
+            for i in range(0, len(anios), MAX_ADJUNTOS)]
+
+
+def _indexar(conn, esquema):
+    conn.exec_driver_sql(ddl_tabla_fts('gastos_fts', esquema))
+    conn.exec_driver_sql(f"INSERT INTO {esquema}.gastos_fts(gastos_fts) VALUES ('rebuild')")
+
+
+def indexar_archivo(directorio):
+    """Crea o reconstruye el índice de búsqueda de cada archivo anual"""
+    anios = anios_archivados()
+    engine = db.session.get_bind()
+    with engine.connect() as conn:
+        for anio in anios:
+            ruta = ruta_archivo(directorio, anio)
+            if not os.path.exists(ruta):
+                raise ArchivoError(f'Falta el archivo del año {anio}')
+            conn.exec_driver_sql(f'ATTACH DATABASE ? AS {esquema_archivo(anio)}', (ruta,))
+            try:
+                _indexar(conn, esquema_archivo(anio))
+                conn.commit()
+            finally:
+                conn.exec_driver_sql(f'DETACH DATABASE {esquema_archivo(anio)}')
+    return anios
+
+
+def _archivar_anio(conn, a, directorio, movidos):
+    """Mueve al archivo del año `a` sus filas de temp.lotes_archivar y gastos
+
+    Un COMMIT con bases adjuntas en WAL no es atómico entre archivos, así
+    que el movimiento se hace en dos transacciones: primero se copia al
+    archivo y se confirma; después se verifica que cada fila tenga su copia
+    idéntica y recién entonces se borra de la base activa. Si algo falla
+    entre ambas, las filas siguen en la base activa (resumen_archivado no
+    cambió) y repetir el archivado es seguro gracias a INSERT OR REPLACE.
+    """
+    # Crear el archivo anual con el mismo esquema
+    motor_archivo = create_engine(f'sqlite:///{ruta_archivo(directorio, a)}')
+    db.metadata.create_all(motor_archivo, tables=TABLAS_ARCHIVO)
+    motor_archivo.dispose()
+
+    e = esquema_archivo(a)
+    sentencias = {
+        'produccion': 'anio = ? AND id IN (SELECT id FROM temp.lotes_archivar)',
+        'ventas': 'anio_venta = ? AND produccion_id IN (SELECT id FROM temp.lotes_archivar)',
+        'gastos': 'anio_gasto = ?'
+    }
+    conn.exec_driver_sql(f'ATTACH DATABASE ? AS {e}', (ruta_archivo(directorio, a),))
+    try:
+        # 1) Copiar al archivo. OR REPLACE: archivar de nuevo un año (p. ej.
+        # tras restaurar un respaldo previo) no choca con los ids ya archivados
+        for tabla, condicion in sentencias.items():
+            conn.exec_driver_sql(
+                f'INSERT OR REPLACE INTO {e}.{tabla} SELECT * FROM main.{tabla} WHERE {condicion}', (a,))
+
+        # Resumen mensual del año, recalculado desde el propio archivo
+        conn.exec_driver_sql(f'DELETE FROM {e}.resumen_archivado')
+        conn.exec_driver_sql(f'''
+            INSERT INTO {e}.resumen_archivado
+                (anio, mes, ventas, ganancias, gastos_fabrica, gastos_personal,
+                 unidades_vendidas, unidades_producidas)
+            SELECT ?, mes, sum(ventas), sum(ganancias), sum(fabrica), sum(personal),
+                   sum(vendidas), sum(producidas)
+            FROM (
+                SELECT mes_venta AS mes, precio_aplicado * cantidad - descuento AS ventas,
+                       ganancia_real AS ganancias, 0 AS fabrica, 0 AS personal,
+                       cantidad AS vendidas, 0 AS producidas
+                FROM {e}.ventas
+                UNION ALL
+                SELECT mes_gasto, 0, 0,
+                       CASE WHEN tipo = 'Fabrica' THEN monto ELSE 0 END,
+                       CASE WHEN tipo = 'Personal' THEN monto ELSE 0 END, 0, 0
+                FROM {e}.gastos
+                UNION ALL
+                SELECT mes, 0, 0, 0, 0, 0, cantidad FROM {e}.produccion
+            ) GROUP BY mes
+        ''', (a,))
+        # Índice de búsqueda propio del archivo
+        _indexar(conn, e)
+        conn.commit()
+
+        # 2) Verificar y borrar de la base activa. IMMEDIATE toma el lock de
+        # escritura antes de contar: nadie modifica esas filas entre la
+        # verificación y el borrado
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+        for tabla, condicion in sentencias.items():
+            pendientes = conn.exec_driver_sql(
+                f'SELECT count(*) FROM main.{tabla} WHERE {condicion}', (a,)).scalar()
+            copiadas = conn.exec_driver_sql(
+                f'SELECT count(*) FROM (SELECT * FROM main.{tabla} WHERE {condicion} '
+                f'INTERSECT SELECT * FROM {e}.{tabla})', (a,)).scalar()
+            if copiadas != pendientes:
+                raise ArchivoError(f'{tabla} de {a} cambió durante el archivado; vuelva a intentarlo')
+            # El trigger de borrado quita estos gastos de gastos_fts en la base activa
+            movidos[tabla] += conn.exec_driver_sql(
+                f'DELETE FROM main.{tabla} WHERE {condicion}', (a,)).rowcount
+
+        conn.exec_driver_sql('DELETE FROM main.resumen_archivado WHERE anio = ?', (a,))
+        conn.exec_driver_sql(
+            f'INSERT INTO main.resumen_archivado SELECT * FROM {e}.resumen_archivado')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.exec_driver_sql(f'DETACH DATABASE {e}')
+
+
+def archivar_hasta(anio, directorio, compactar=True):
+    """Mueve al archivo los movimientos cerrados hasta `anio` inclusive
+
+    Se archivan todos los gastos de esos años y los lotes de producción
+    totalmente vendidos cuyas ventas también caen en esos años, junto con
+    esas ventas; así el stock por producto y por lote sigue cuadrando con
+    los datos que quedan en la base activa. Cada fila va al archivo de su
+    propio año y resumen_archivado se recalcula desde los archivos.
+    """
+    if anio >= datetime.now().year:
+        raise ArchivoError('Solo se pueden archivar años cerrados')
+
+    os.makedirs(directorio, exist_ok=True)
+    engine = db.session.get_bind()
+    db.session.remove()
+
+    with engine.connect() as conn:
+        conn.exec_driver_sql('DROP TABLE IF EXISTS temp.lotes_archivar')
+        conn.exec_driver_sql('''
+            CREATE TEMP TABLE lotes_archivar AS
+            SELECT p.id FROM produccion p
+            JOIN (SELECT produccion_id, sum(cantidad) AS vendido, max(anio_venta) AS ultimo
+                  FROM ventas GROUP BY produccion_id) v ON v.produccion_id = p.id
+            WHERE p.anio <= ? AND v.ultimo <= ? AND v.vendido >= p.cantidad
+        ''', (anio, anio))
+
+        anios = sorted({a for a, in conn.exec_driver_sql('''
+            SELECT anio FROM produccion WHERE id IN (SELECT id FROM temp.lotes_archivar)
+            UNION SELECT anio_venta FROM ventas WHERE produccion_id IN (SELECT id FROM temp.lotes_archivar)
+            UNION SELECT anio_gasto FROM gastos WHERE anio_gasto <= ?
+        ''', (anio,))})
+
+        movidos = {'produccion': 0, 'ventas': 0, 'gastos': 0}
+        try:
+            # Un año por vez: adjuntar, mover, confirmar y separar (SQLite
+            # limita la cantidad de bases adjuntas por conexión)
+            for a in anios:
+                _archivar_anio(conn, a, directorio, movidos)
+        finally:
+            conn.exec_driver_sql('DROP TABLE IF EXISTS temp.lotes_archivar')
+
+    if compactar:
+        # Devolver al sistema el espacio liberado en la base activa
+        with engine.connect() as conn:
+            conn.exec_driver_sql('VACUUM')
+
+    return {'anios': anios, 'movidos': movidos}
+
+
+# Consultas que alcanzan años archivados
+
+def totales_rango_archivados(desde, hasta, directorio):
+    """Totales de los archivos que caen en el rango de fechas"""
+    totales = []
+    for grupo in grupos_adjuntos(anios_en_rango(desde, hasta), directorio):
+        with grupo as esquemas:
+            for esquema in esquemas:
+                totales.append(calcular_totales_rango(desde, hasta, esquema=esquema))
+    return sumar_totales(*totales) if totales else None
+
+
+def series_archivadas(desde, hasta, granularidad, directorio):
+    """totales_por_periodo sobre los archivos que caen en el rango"""
+    series = []
+    for grupo in grupos_adjuntos(anios_en_rango(desde, hasta), directorio):
+        with grupo as esquemas:
+            for esquema in esquemas:
+                series.append(totales_por_periodo(desde, hasta, granularidad, esquema=esquema))
+    return combinar_series(*series)
+
+
+def combinar_series(*series):
+    """Suma filas de totales_por_periodo con el mismo período"""
+    por_periodo = {}
+    for serie in series:
+        for fila in serie:
+            if fila['periodo'] in por_periodo:
+                actual = por_periodo[fila['periodo']]
+                for clave, valor in fila.items():
+                    if clave != 'periodo':
+                        actual[clave] += valor
+            else:
+                por_periodo[fila['periodo']] = dict(fila)
+    return [por_periodo[p] for p in sorted(por_periodo)]
+
+
+def _filtros(columnas_venta, columnas_gasto, mes, anio, desde, hasta):
+    if desde or hasta:
+        return (filtro_fechas(columnas_venta.fecha, desde, hasta),
+                filtro_fechas(columnas_gasto.fecha, desde, hasta))
+    filtros_venta = [columnas_venta.anio_venta == anio]
+    filtros_gasto = [columnas_gasto.anio_gasto == anio]
+    if mes:
+        filtros_venta.append(columnas_venta.mes_venta == mes)
+        filtros_gasto.append(columnas_gasto.mes_gasto == mes)
+    return filtros_venta, filtros_gasto
+
+
+def detalle_archivado(directorio, mes=None, anio=None, desde=None, hasta=None, limite=None):
+    """Ventas y gastos archivados del período, como diccionarios (más recientes primero)"""
+    if not (anio or desde or hasta):
+        return [], []
+
+    ventas = []
+    gastos = []
+    for grupo in grupos_adjuntos(anios_en_rango(desde, hasta, anio), directorio):
+        with grupo as esquemas:
+            for esquema in esquemas:
+                v, g, _ = columnas_de(esquema)
+                filtros_venta, filtros_gasto = _filtros(v, g, mes, anio, desde, hasta)
+                consulta_ventas = db.session.query(*v).filter(*filtros_venta).order_by(v.fecha.desc())
+                consulta_gastos = db.session.query(*g).filter(*filtros_gasto).order_by(g.fecha.desc())
+                if limite:
+                    consulta_ventas = consulta_ventas.limit(limite)
+                    consulta_gastos = consulta_gastos.limit(limite)
+                ventas.extend(fila._asdict() for fila in consulta_ventas.all())
+                gastos.extend(fila._asdict() for fila in consulta_gastos.all())
+
+    nombres = dict(db.session.query(Producto.id, Producto.nombre).filter(
+        Producto.id.in_({v['producto_id'] for v in ventas})).all()) if ventas else {}
+    for venta in ventas:
+        venta['producto_nombre'] = nombres.get(venta['producto_id'])
+        venta['archivado'] = True
+    for gasto in gastos:
+        gasto['archivado'] = True
+
+    ventas.sort(key=lambda v: v['fecha'] or datetime.min, reverse=True)
+    gastos.sort(key=lambda g: g['fecha'] or datetime.min, reverse=True)
+    return ventas[:limite] if limite else ventas, gastos[:limite] if limite else gastos
+
+
+def resumen_archivo():
+    """Resumen por año de lo archivado"""
+    filas = db.session.query(
+        ResumenArchivado.anio,
+        func.sum(ResumenArchivado.ventas),
+        func.sum(ResumenArchivado.ganancias),
+        func.sum(ResumenArchivado.gastos_fabrica),
+        func.sum(ResumenArchivado.gastos_personal),
+        func.sum(ResumenArchivado.unidades_vendidas),
+        func.sum(ResumenArchivado.unidades_producidas)
+    ).group_by(ResumenArchivado.anio).order_by(ResumenArchivado.anio).all()
+
+    return [{
+        'anio': anio,
+        'ventas': ventas or 0,
+        'ganancias': ganancias or 0,
+        'gastos_fabrica': fabrica or 0,
+        'gastos_personal': personal or 0,
+        'unidades_vendidas': vendidas or 0,
+        'unidades_producidas': producidas or 0
+    } for anio, ventas, ganancias, fabrica, personal, vendidas, producidas in filas]
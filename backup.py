@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Respaldos en Caliente - Sistema de Gestión de Fábrica
+API de backup online de SQLite, snapshots comprimidos y restauración
+"""
+
+import os
+import json
+import gzip
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+from datetime import datetime
+
+# La copia se hace en un solo paso dentro de una transacción de lectura.
+# En WAL (ver models.configurar_sqlite) no bloquea a los escritores; en modo
+# rollback-journal los demora mientras dura la copia. Copiar por lotes de
+# páginas haría que SQLite reinicie el respaldo cada vez que otra conexión
+# escribe, y con ventas constantes podría no terminar nunca.
+TIMEOUT_LOCK = 30  # Segundos que se espera el lock de escritura al restaurar
+BACKUPS_A_CONSERVAR = 7
+
+PREFIJO = 'fabrica'
+EXTENSION = '.db.gz'
+
+
+class BackupError(Exception):
+    """Error al crear, verificar o restaurar un respaldo"""
+
+
+def _sha256_archivo(ruta):
+    """Calcula el SHA-256 de un archivo leyendo por bloques"""
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def _ruta_manifiesto(ruta_backup):
+    return ruta_backup[:-len(EXTENSION)] + '.json'
+
+
+def _copiar_online(origen, destino):
+    """Copia una base SQLite a otra con la API de backup, en un único paso
+
+    Si el destino está ocupado (restauración con la app abierta) el busy
+    timeout de la conexión espera el lock en lugar de reintentar en bucle.
+    """
+    src = sqlite3.connect(origen, timeout=TIMEOUT_LOCK)
+    dst = sqlite3.connect(destino, timeout=TIMEOUT_LOCK)
+    try:
+        src.backup(dst)
+        paginas_total = dst.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    return paginas_total
+
+
+def _copiar_comprimido(origen, ruta_gz):
+    """Copia online una base a un .gz; devuelve (páginas, tamaño sin comprimir)"""
+    ruta_tmp = ruta_gz[:-len('.gz')] + '.tmp'
+    try:
+        paginas_total = _copiar_online(origen, ruta_tmp)
+        with open(ruta_tmp, 'rb') as f_in, gzip.open(ruta_gz, 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        return paginas_total, os.path.getsize(ruta_tmp)
+    finally:
+        if os.path.exists(ruta_tmp):
+            os.remove(ruta_tmp)
+
+
+def _archivos_anuales(archivo_dir):
+    """Bases del archivo histórico (fabrica_<anio>.db) de una fábrica"""
+    if not archivo_dir or not os.path.isdir(archivo_dir):
+        return []
+    return sorted(a for a in os.listdir(archivo_dir) if a.endswith('.db'))
+
+
+def _dir_archivo_backup(ruta_backup):
+    return ruta_backup[:-len(EXTENSION)] + '.archivo'
+
+
+def crear_backup(db_path, backup_dir, etiqueta=None, conservar=BACKUPS_A_CONSERVAR, archivo_dir=None):
+    """Crea un snapshot comprimido y verificado de la base sin detener la app
+
+    Con archivo_dir también se copian las bases anuales del archivo
+    histórico: son la única copia de los años archivados.
+    """
+    if not os.path.exists(db_path):
+        raise BackupError('La base de datos no existe')
+
+    os.makedirs(backup_dir, exist_ok=True)
+    marca = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    nombre = f'{PREFIJO}-{marca}'
+    if etiqueta:
+        nombre += f'-{etiqueta}'
+
+    ruta_backup = os.path.join(backup_dir, nombre + EXTENSION)
+    inicio = time.time()
+    paginas_total, tamanio_original = _copiar_comprimido(db_path, ruta_backup)
+
+    archivos = []
+    anuales = _archivos_anuales(archivo_dir)
+    if anuales:
+        destino = _dir_archivo_backup(ruta_backup)
+        os.makedirs(destino, exist_ok=True)
+        for archivo in anuales:
+            ruta_gz = os.path.join(destino, archivo + '.gz')
+            _copiar_comprimido(os.path.join(archivo_dir, archivo), ruta_gz)
+            archivos.append({'nombre': archivo, 'sha256': _sha256_archivo(ruta_gz)})
+
+    manifiesto = {
+        'nombre': nombre + EXTENSION,
+        'creado': datetime.now().isoformat(),
+        'sha256': _sha256_archivo(ruta_backup),
+        'tamanio': os.path.getsize(ruta_backup),
+        'tamanio_original': tamanio_original,
+        'paginas': paginas_total,
+        'duracion_seg': round(time.time() - inicio, 3),
+        'etiqueta': etiqueta
+    }
+    if archivo_dir:
+        manifiesto['archivos'] = archivos
+    with open(_ruta_manifiesto(ruta_backup), 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f, indent=2)
+
+    if conservar:
+        rotar_backups(backup_dir, conservar)
+    return manifiesto
+
+
+def listar_backups(backup_dir):
+    """Lista los respaldos disponibles, del más reciente al más antiguo"""
+    if not os.path.isdir(backup_dir):
+        return []
+
+    backups = []
+    for archivo in os.listdir(backup_dir):
+        if not (archivo.startswith(PREFIJO) and archivo.endswith(EXTENSION)):
+            continue
+        ruta = os.path.join(backup_dir, archivo)
+        try:
+            with open(_ruta_manifiesto(ruta), encoding='utf-8') as f:
+                backups.append(json.load(f))
+        except (OSError, ValueError):
+            # Snapshot sin manifiesto: no se puede verificar
+            backups.append({'nombre': archivo, 'creado': None, 'sha256': None,
+                            'tamanio': os.path.getsize(ruta)})
+
+    backups.sort(key=lambda b: b['nombre'], reverse=True)
+    return backups
+
+
+def rotar_backups(backup_dir, conservar=BACKUPS_A_CONSERVAR):
+    """Elimina los respaldos más antiguos, conservando los últimos `conservar`"""
+    eliminados = []
+    for backup in listar_backups(backup_dir)[conservar:]:
+        ruta = os.path.join(backup_dir, backup['nombre'])
+        for archivo in (ruta, _ruta_manifiesto(ruta)):
+            if os.path.exists(archivo):
+                os.remove(archivo)
+        shutil.rmtree(_dir_archivo_backup(ruta), ignore_errors=True)
+        eliminados.append(backup['nombre'])
+    return eliminados
+
+
+def _resolver_backup(nombre, backup_dir):
+    """Devuelve la ruta de un respaldo validando que esté dentro de backup_dir"""
+    if os.path.basename(nombre) != nombre or not nombre.endswith(EXTENSION):
+        raise BackupError('Nombre de respaldo inválido')
+    ruta = os.path.join(backup_dir, nombre)
+    if not os.path.exists(ruta):
+        raise BackupError('El respaldo no existe')
+    return ruta
+
+
+def verificar_backup(nombre, backup_dir):
+    """Comprueba los checksums del respaldo (y su archivo) contra el manifiesto
+
+    Devuelve (ruta, manifiesto).
+    """
+    ruta = _resolver_backup(nombre, backup_dir)
+    try:
+        with open(_ruta_manifiesto(ruta), encoding='utf-8') as f:
+            manifiesto = json.load(f)
+        esperado = manifiesto['sha256']
+    except (OSError, ValueError, KeyError):
+        raise BackupError('El respaldo no tiene manifiesto')
+
+    if _sha256_archivo(ruta) != esperado:
+        raise BackupError('Checksum inválido: el respaldo está dañado')
+    for archivo in manifiesto.get('archivos', []):
+        ruta_gz = os.path.join(_dir_archivo_backup(ruta), archivo['nombre'] + '.gz')
+        if not os.path.exists(ruta_gz) or _sha256_archivo(ruta_gz) != archivo['sha256']:
+            raise BackupError(f"Checksum inválido: el archivo {archivo['nombre']} está dañado")
+    return ruta, manifiesto
+
+
+def _restaurar_base(ruta_gz, destino, ruta_tmp):
+    """Descomprime, pasa integrity_check y copia sobre `destino` con la API de backup"""
+    try:
+        with gzip.open(ruta_gz, 'rb') as f_in, open(ruta_tmp, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+        conn = sqlite3.connect(ruta_tmp)
+        try:
+            resultado = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            conn.close()
+        if resultado != 'ok':
+            raise BackupError(f'{os.path.basename(ruta_gz)} no pasa integrity_check: {resultado}')
+
+        # Copiar hacia la base activa; SQLite toma el lock de escritura
+        _copiar_online(ruta_tmp, destino)
+    finally:
+        if os.path.exists(ruta_tmp):
+            os.remove(ruta_tmp)
+
+
+def restaurar_backup(nombre, db_path, backup_dir, archivo_dir=None):
+    """Restaura un respaldo sobre la base activa usando la API de backup
+
+    Si el respaldo incluye el archivo histórico y se indica archivo_dir,
+    las bases anuales vuelven al estado del respaldo: las que no estaban
+    se eliminan (quedan en el respaldo previo a la restauración), así el
+    archivo coincide con resumen_archivado de la base restaurada.
+    """
+    ruta, manifiesto = verificar_backup(nombre, backup_dir)
+    base = os.path.join(backup_dir, nombre[:-len(EXTENSION)])
+    _restaurar_base(ruta, db_path, base + '.restore.tmp')
+
+    archivos = manifiesto.get('archivos')
+    if archivo_dir and archivos is not None:
+        os.makedirs(archivo_dir, exist_ok=True)
+        nombres = {a['nombre'] for a in archivos}
+        for archivo in nombres:
+            _restaurar_base(os.path.join(_dir_archivo_backup(ruta), archivo + '.gz'),
+                            os.path.join(archivo_dir, archivo), base + '.archivo.tmp')
+        for archivo in _archivos_anuales(archivo_dir):
+            if archivo not in nombres:
+                for sufijo in ('', '-wal', '-shm'):
+                    if os.path.exists(os.path.join(archivo_dir, archivo + sufijo)):
+                        os.remove(os.path.join(archivo_dir, archivo + sufijo))
+
+    return {'restaurado': nombre, 'fecha': datetime.now().isoformat()}
+
+
+# Estado del respaldo en segundo plano: uno a la vez por base de datos
+_registro_lock = threading.Lock()
+_locks = {}    # db_path -> Lock
+_estados = {}  # db_path -> estado
+
+
+def _lock_y_estado(db_path):
+    clave = os.path.abspath(db_path)
+    with _registro_lock:
+        if clave not in _locks:
+            _locks[clave] = threading.Lock()
+            _estados[clave] = {'en_curso': False, 'ultimo': None, 'error': None}
+        return _locks[clave], _estados[clave]
+
+
+def estado_backup(db_path):
+    """Estado del último respaldo lanzado en segundo plano para una base"""
+    return dict(_lock_y_estado(db_path)[1])
+
+
+def iniciar_backup_en_segundo_plano(db_path, backup_dir, **kwargs):
+    """Lanza crear_backup en un hilo; devuelve False si esa base ya tiene uno en curso"""
+    lock, estado = _lock_y_estado(db_path)
+    if not lock.acquire(blocking=False):
+        return False
+
+    def tarea():
+        try:
+            estado.update(en_curso=True, error=None)
+            estado['ultimo'] = crear_backup(db_path, backup_dir, **kwargs)
+        except (BackupError, OSError, sqlite3.Error) as e:
+            estado['error'] = str(e)
+        finally:
+            estado['en_curso'] = False
+            lock.release()
+
+    estado['en_curso'] = True
+    threading.Thread(target=tarea, name='backup-fabrica', daemon=True).start()
+    return True
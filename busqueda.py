@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Búsqueda de Texto - Sistema de Gestión de Fábrica
+Índices FTS5 de SQLite sobre productos y conceptos de gastos
+"""
+
+import re
+
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import OperationalError
+
+from models import db, Producto, Venta, Gasto, columnas_de
+
+# Tabla FTS -> (tabla de contenido, columna indexada)
+INDICES_FTS = {
+    'productos_fts': ('productos', 'nombre'),
+    'gastos_fts': ('gastos', 'concepto')
+}
+
+TIPOS_BUSQUEDA = ('productos', 'gastos', 'ventas')
+MAX_POR_PAGINA = 100
+
+# Conteo máximo por tipo: más allá se informa "más de TOPE_CONTEO". Con más
+# coincidencias que eso (prefijos cortos mientras se escribe) ordenar todo
+# por bm25 cuesta decenas de ms, así que se ordena por id (más recientes).
+TOPE_CONTEO = 1000
+
+# Largos de prefijo indexados: "har"* lee un solo término del índice en
+# lugar de unir las listas de harina, harinas, harinero...
+PREFIJOS_FTS = '2 3 4'
+
+
+class BusquedaNoDisponible(Exception):
+    """SQLite compilado sin FTS5"""
+
+
+def ddl_tabla_fts(fts, esquema=None):
+    """CREATE de la tabla virtual de contenido externo (en la base activa o en un esquema adjunto)"""
+    tabla, columna = INDICES_FTS[fts]
+    nombre = f'{esquema}.{fts}' if esquema else fts
+    return (f"CREATE VIRTUAL TABLE IF NOT EXISTS {nombre} USING fts5("
+            f"{columna}, content='{tabla}', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2', prefix='{PREFIJOS_FTS}')")
+
+
+def _ddl_fts(fts, tabla, columna):
+    """Tabla virtual de contenido externo y triggers que la mantienen"""
+    return [
+        ddl_tabla_fts(fts),
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {tabla} BEGIN "
+        f"INSERT INTO {fts}(rowid, {columna}) VALUES (new.id, new.{columna}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {tabla} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columna}) VALUES ('delete', old.id, old.{columna}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {columna} ON {tabla} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columna}) VALUES ('delete', old.id, old.{columna}); "
+        f"INSERT INTO {fts}(rowid, {columna}) VALUES (new.id, new.{columna}); END"
+    ]
+
+
+def crear_fts(engine):
+    """Crea las tablas FTS y sus triggers; indexa los datos existentes la primera vez"""
+    existentes = set(inspect(engine).get_table_names())
+    try:
+        with engine.begin() as conn:
+            for fts, (tabla, columna) in INDICES_FTS.items():
+                if fts in existentes:
+                    ddl = conn.exec_driver_sql(
+                        "SELECT sql FROM sqlite_master WHERE name = ?", (fts,)).scalar()
+                    if f"prefix='{PREFIJOS_FTS}'" not in ddl:
+                        # Índice creado con otros prefijos (o sin ellos): recrearlo
+                        conn.exec_driver_sql(f"DROP TABLE {fts}")
+                        existentes.discard(fts)
+                for sentencia in _ddl_fts(fts, tabla, columna):
+                    conn.exec_driver_sql(sentencia)
+                if fts not in existentes:
+                    conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    except OperationalError as e:
+        if 'fts5' in str(e):
+            raise BusquedaNoDisponible('SQLite no tiene soporte FTS5')
+        raise
+
+
+def reconstruir_fts(engine):
+    """Reindexa por completo las tablas FTS (bases existentes o dañadas)"""
+    crear_fts(engine)
+    with engine.begin() as conn:
+        for fts in INDICES_FTS:
+            conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def consulta_fts(q):
+    """Convierte texto libre en una consulta FTS5 de prefijos: "pan"* "dul"*"""
+    palabras = re.findall(r'\w+', q or '')
+    return ' '.join(f'"{p}"*' for p in palabras)
+
+
+def _contar(desde, params):
+    """count(*) acotado a TOPE_CONTEO + 1 filas; devuelve (total, hay_mas)"""
+    total = db.session.execute(
+        text(f"SELECT count(*) FROM (SELECT 1 {desde} LIMIT {TOPE_CONTEO + 1})"), params
+    ).scalar()
+    return min(total, TOPE_CONTEO), total > TOPE_CONTEO
+
+
+def _desde_fts(fts, filtro_sql='', esquema=None):
+    """FROM/WHERE de una búsqueda FTS en la base activa o en un archivo adjunto"""
+    tabla, _ = INDICES_FTS[fts]
+    prefijo = f'{esquema}.' if esquema else ''
+    if filtro_sql:
+        # Solo se une con la tabla de contenido si hay que filtrar por ella
+        return (f"FROM {prefijo}{fts} JOIN {prefijo}{tabla} t ON t.id = {fts}.rowid "
+                f"WHERE {fts} MATCH :q {filtro_sql}")
+    return f"FROM {prefijo}{fts} WHERE {fts} MATCH :q"
+
+
+def _desde_ventas(esquema=None):
+    """Ventas de los productos cuyo nombre coincide (el índice de productos está en main)"""
+    prefijo = f'{esquema}.' if esquema else ''
+    return (f"FROM {prefijo}ventas v WHERE v.producto_id IN "
+            f"(SELECT rowid FROM main.productos_fts WHERE productos_fts MATCH :q)")
+
+
+def _fuente(esquema, desde, columna_id, rango, params, limite):
+    """Conteo acotado y mejores filas de una fuente (base activa o un archivo)
+
+    Devuelve (total, hay_mas, por_id, por_rango); las filas son (clave,
+    esquema, id) con clave ascendente. por_rango (bm25) solo se calcula si
+    hay rango y la fuente no supera TOPE_CONTEO: con más coincidencias
+    ordenar todas por relevancia es caro y se usará el orden por id.
+    """
+    total, hay_mas = _contar(desde, params)
+    # id: mayor (más reciente) primero
+    por_id = [(-id_, esquema, id_) for id_, in db.session.execute(
+        text(f"SELECT {columna_id} {desde} ORDER BY {columna_id} DESC LIMIT :limite"),
+        {**params, 'limite': limite})]
+    por_rango = None
+    if rango and not hay_mas:
+        # bm25: menor es mejor
+        por_rango = [(clave, esquema, id_) for id_, clave in db.session.execute(
+            text(f"SELECT {columna_id}, {rango} {desde} ORDER BY {rango} LIMIT :limite"),
+            {**params, 'limite': limite})]
+    return total, hay_mas, por_id, por_rango
+
+
+def _combinar(fuentes, limite, offset):
+    """Cuenta y pagina varias fuentes (base activa y archivos) como una sola
+
+    Se ordena por relevancia salvo que alguna fuente no tenga rango o que
+    entre todas haya demasiadas coincidencias; entonces, por id descendente.
+    Devuelve ([(esquema, id)], total, hay_mas).
+    """
+    suma = sum(total for total, _, _, _ in fuentes)
+    hay_mas = suma > TOPE_CONTEO or any(mas for _, mas, _, _ in fuentes)
+    por_rango = not hay_mas and all(rango is not None for _, _, _, rango in fuentes)
+
+    filas = []
+    for _, _, por_id, rango in fuentes:
+        filas.extend(rango if por_rango else por_id)
+    filas.sort(key=lambda fila: fila[0])
+    return [(esquema, id_) for _, esquema, id_ in filas[offset:offset + limite]], min(suma, TOPE_CONTEO), hay_mas
+
+
+def _con_fts(esquemas, fts):
+    """Esquemas adjuntos que tienen el índice FTS (archivos anteriores no lo tienen)"""
+    return [e for e in esquemas if db.session.execute(
+        text(f"SELECT 1 FROM {e}.sqlite_master WHERE name = :fts"), {'fts': fts}).first()]
+
+
+def _en_orden(modelo, ids):
+    """Carga objetos por id respetando el orden de relevancia"""
+    if not ids:
+        return []
+    por_id = {o.id: o for o in modelo.query.filter(modelo.id.in_(ids)).all()}
+    return [por_id[i] for i in ids if i in por_id]
+
+
+def _items(modelo, posicion, encontrados, esquemas):
+    """Diccionarios de las filas encontradas en la base activa (None) o en
+    los archivos adjuntos de `esquemas`, indexados por (esquema, id)"""
+    por_esquema = {}
+    for esquema, id_ in encontrados:
+        if esquema in esquemas:
+            por_esquema.setdefault(esquema, []).append(id_)
+
+    cargados = {}
+    if None in por_esquema:
+        cargados = {(None, o.id): o.to_dict() for o in _en_orden(modelo, por_esquema.pop(None))}
+    for esquema, ids in por_esquema.items():
+        columnas = columnas_de(esquema)[posicion]
+        for fila in db.session.query(*columnas).filter(columnas.id.in_(ids)).all():
+            item = fila._asdict()
+            item['fecha'] = item['fecha'].isoformat() if item['fecha'] else None
+            item['archivado'] = True
+            cargados[(esquema, item['id'])] = item
+
+    if modelo is Venta:
+        sin_nombre = [i for i in cargados.values() if 'producto_nombre' not in i]
+        nombres = dict(db.session.query(Producto.id, Producto.nombre).filter(
+            Producto.id.in_({i['producto_id'] for i in sin_nombre})).all()) if sin_nombre else {}
+        for item in sin_nombre:
+            item['producto_nombre'] = nombres.get(item['producto_id'])
+    return cargados
+
+
+def buscar(q, tipos=TIPOS_BUSQUEDA, pagina=1, por_pagina=20, archivos=None):
+    """Busca productos, gastos y ventas (por nombre de producto) con paginación
+
+    `archivos(esquemas=None)` devuelve los grupos de archivos anuales a
+    adjuntar (archivo.grupos_adjuntos): sus gastos y ventas se incluyen en
+    los resultados marcados como archivados. Los grupos se adjuntan de a
+    uno, así se respeta el límite de bases adjuntas de SQLite.
+    """
+    match = consulta_fts(q)
+    por_pagina = max(1, min(por_pagina, MAX_POR_PAGINA))
+    offset = (max(pagina, 1) - 1) * por_pagina
+    resultado = {'q': q, 'pagina': max(pagina, 1), 'por_pagina': por_pagina}
+    if not match:
+        return resultado
+
+    params = {'q': match}
+    # (tipo, modelo, posición en columnas_de): los que existen en los archivos
+    movimientos = [t for t in (('gastos', Gasto, 1), ('ventas', Venta, 0)) if t[0] in tipos]
+    fuentes = {tipo: [] for tipo, _, _ in movimientos}
+
+    def consultar(esquemas):
+        """Agrega las fuentes de gastos y ventas de la base activa o de archivos adjuntos"""
+        for tipo, _, _ in movimientos:
+            if tipo == 'gastos':
+                # Más relevantes primero; archivos anteriores pueden no tener índice
+                consultas = [(e, _desde_fts('gastos_fts', esquema=e), 'gastos_fts.rowid', 'bm25(gastos_fts)')
+                             for e in esquemas if e is None or _con_fts([e], 'gastos_fts')]
+            else:
+                # Más recientes (por id) primero: recorre el índice de producto_id
+                # sin ordenar toda la tabla; el total se cuenta acotado
+                consultas = [(e, _desde_ventas(e), 'v.id', None) for e in esquemas]
+            fuentes[tipo].extend(_fuente(*consulta, params, offset + por_pagina) for consulta in consultas)
+
+    try:
+        if 'productos' in tipos:
+            encontrados, total, hay_mas = _combinar(
+                [_fuente(None, _desde_fts('productos_fts', 'AND t.activo = 1'),
+                         'productos_fts.rowid', 'bm25(productos_fts)', params, offset + por_pagina)],
+                por_pagina, offset)
+            resultado['productos'] = {
+                'total': total,
+                'hay_mas': hay_mas,
+                'items': [p.to_dict() for p in _en_orden(Producto, [i for _, i in encontrados])]
+            }
+
+        if movimientos:
+            consultar([None])
+            for grupo in archivos() if archivos else []:
+                with grupo as esquemas:
+                    consultar(esquemas)
+
+            paginas = {tipo: _combinar(fuentes[tipo], por_pagina, offset) for tipo, _, _ in movimientos}
+            cargados = {tipo: _items(modelo, posicion, paginas[tipo][0], [None])
+                        for tipo, modelo, posicion in movimientos}
+            # Solo se vuelven a adjuntar los archivos que aportan filas a la página
+            necesarios = {e for encontrados, _, _ in paginas.values() for e, _ in encontrados if e}
+            if necesarios:
+                for grupo in archivos(necesarios):
+                    with grupo as esquemas:
+                        for tipo, modelo, posicion in movimientos:
+                            cargados[tipo].update(_items(modelo, posicion, paginas[tipo][0], esquemas))
+
+            for tipo, _, _ in movimientos:
+                encontrados, total, hay_mas = paginas[tipo]
+                resultado[tipo] = {
+                    'total': total,
+                    'hay_mas': hay_mas,
+                    'items': [cargados[tipo][e] for e in encontrados if e in cargados[tipo]]
+                }
+    except OperationalError as e:
+        if 'fts5' in str(e) or 'no such table' in str(e):
+            raise BusquedaNoDisponible('Índice de búsqueda no disponible')
+        raise
+
+    return resultado
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Escritura Agrupada - Sistema de Gestión de Fábrica
+Un hilo escritor por base que aplica las escrituras en lotes (group commit)
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from werkzeug.exceptions import HTTPException
+
+from models import db
+
+VENTANA_LOTE = 0.005  # Segundos que se espera para juntar más escrituras
+TAMANIO_LOTE = 32
+TIMEOUT_RESULTADO = 30
+
+
+class _Tarea:
+    __slots__ = ('funcion', 'args', 'futuro')
+
+    def __init__(self, funcion, args):
+        self.funcion = funcion
+        self.args = args
+        self.futuro = Future()
+
+
+class ColaEscritura:
+    """Serializa las escrituras de una base en un único hilo
+
+    Cada función recibe sus argumentos, modifica db.session sin hacer
+    commit y devuelve (payload, status). Un lote de tareas se confirma con
+    un solo commit; si el lote falla se deshace y las tareas se reintentan
+    una por una, así cada request recibe su propio resultado o error.
+    """
+
+    def __init__(self, app, preparar_contexto, ventana=VENTANA_LOTE, tamanio_lote=TAMANIO_LOTE,
+                 nombre='escritor'):
+        self.app = app
+        self.preparar_contexto = preparar_contexto
+        self.ventana = ventana
+        self.tamanio_lote = tamanio_lote
+        self.estadisticas = {'lotes': 0, 'escrituras': 0, 'reintentos': 0, 'mayor_lote': 0}
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._bucle, name=nombre, daemon=True)
+        self._hilo.start()
+
+    def enviar(self, funcion, *args):
+        """Encola una escritura y devuelve un Future con (payload, status)"""
+        tarea = _Tarea(funcion, args)
+        self._cola.put(tarea)
+        return tarea.futuro
+
+    def ejecutar(self, funcion, *args):
+        """Encola una escritura y espera su resultado"""
+        return self.enviar(funcion, *args).result(timeout=TIMEOUT_RESULTADO)
+
+    def _siguiente_lote(self):
+        lote = [self._cola.get()]
+        limite = time.monotonic() + self.ventana
+        while len(lote) < self.tamanio_lote:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self._cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _bucle(self):
+        while True:
+            lote = self._siguiente_lote()
+            try:
+                with self.app.app_context():
+                    self.preparar_contexto()
+                    self._aplicar(lote)
+            except Exception as e:
+                # Error fuera de las tareas (p. ej. la base no abre)
+                for tarea in lote:
+                    if not tarea.futuro.done():
+                        tarea.futuro.set_exception(e)
+
+    @staticmethod
+    def _ejecutar_tarea(tarea):
+        """Ejecuta una tarea; los errores HTTP (404, ...) son su resultado"""
+        try:
+            return tarea.funcion(*tarea.args), None
+        except HTTPException as e:
+            return None, e
+
+    def _aplicar(self, lote):
+        resultados = []
+        try:
+            for tarea in lote:
+                resultados.append(self._ejecutar_tarea(tarea))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._aplicar_de_a_una(lote)
+            return
+
+        self.estadisticas['lotes'] += 1
+        self.estadisticas['escrituras'] += len(lote)
+        self.estadisticas['mayor_lote'] = max(self.estadisticas['mayor_lote'], len(lote))
+        for tarea, (resultado, error) in zip(lote, resultados):
+            if error is not None:
+                tarea.futuro.set_exception(error)
+            else:
+                tarea.futuro.set_result(resultado)
+
+    def _aplicar_de_a_una(self, lote):
+        """Reintenta cada tarea en su propia transacción para aislar la que falla"""
+        self.estadisticas['reintentos'] += 1
+        for tarea in lote:
+            try:
+                resultado, error = self._ejecutar_tarea(tarea)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                tarea.futuro.set_exception(e)
+                continue
+            self.estadisticas['lotes'] += 1
+            self.estadisticas['escrituras'] += 1
+            if error is not None:
+                tarea.futuro.set_exception(error)
+            else:
+                tarea.futuro.set_result(resultado)
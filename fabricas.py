@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-Fábrica - Sistema de Gestión de Fábrica
+Una base SQLite por fábrica con caché LRU de engines
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import create_engine
+
+from models import db, crear_indices
+from busqueda import crear_fts
+
+# Fábrica por defecto: usa la base original (database/fabrica.db)
+FABRICA_PRINCIPAL = 'principal'
+PATRON_CLAVE = re.compile(r'^[a-z0-9_-]{1,40}$')
+
+MAX_ENGINES_ABIERTOS = 8
+SEGUNDOS_INACTIVIDAD = 600  # Cierra bases sin uso tras 10 minutos
+
+
+class FabricaError(Exception):
+    """Clave de fábrica inválida o inexistente"""
+
+
+class GestorFabricas:
+    """Resuelve la clave de una fábrica a su engine SQLite
+
+    Los engines se guardan en un LRU acotado; al superar el máximo o tras
+    un período sin uso se cierran (dispose) y se liberan sus conexiones.
+    """
+
+    def __init__(self, directorio, ruta_principal, max_abiertos=MAX_ENGINES_ABIERTOS,
+                 inactividad=SEGUNDOS_INACTIVIDAD):
+        self.directorio = directorio
+        self.ruta_principal = ruta_principal
+        self.max_abiertos = max_abiertos
+        self.inactividad = inactividad
+        self.al_cerrar = []  # Callbacks (clave) al cerrar una fábrica
+        self._engines = OrderedDict()  # clave -> (engine, último uso)
+        self._lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+    def validar_clave(self, clave):
+        if not clave or not PATRON_CLAVE.match(clave):
+            raise FabricaError('Clave de fábrica inválida (a-z, 0-9, _ y -)')
+        return clave
+
+    def ruta_db(self, clave):
+        """Archivo SQLite de una fábrica"""
+        if clave == FABRICA_PRINCIPAL:
+            return self.ruta_principal
+        return os.path.join(self.directorio, f'{self.validar_clave(clave)}.db')
+
+    def existe(self, clave):
+        return os.path.exists(self.ruta_db(clave))
+
+    def listar(self):
+        """Claves de todas las fábricas con base de datos"""
+        claves = [FABRICA_PRINCIPAL] if os.path.exists(self.ruta_principal) else []
+        for archivo in sorted(os.listdir(self.directorio)):
+            clave, extension = os.path.splitext(archivo)
+            if extension == '.db' and PATRON_CLAVE.match(clave) and clave != FABRICA_PRINCIPAL:
+                claves.append(clave)
+        return claves
+
+    def abiertas(self):
+        with self._lock:
+            return list(self._engines)
+
+    def crear(self, clave):
+        """Crea la base de una fábrica nueva con todas sus tablas"""
+        if self.existe(clave):
+            raise FabricaError('La fábrica ya existe')
+        engine = self.engine(clave, crear=True)
+        db.metadata.create_all(engine)
+        crear_indices(engine)
+        crear_fts(engine)
+        return engine
+
+    def abrir(self, clave, crear=False):
+        """Engine nuevo, fuera de la caché, con las tablas al día
+
+        Sirve para consultas puntuales (consolidado) que no deben desalojar
+        a las fábricas en uso; quien lo abre debe cerrarlo con dispose().
+        """
+        if not crear and not self.existe(clave):
+            raise FabricaError('La fábrica no existe')
+        engine = create_engine(f'sqlite:///{self.ruta_db(clave)}')
+        # Tablas agregadas en versiones posteriores a la creación de la fábrica
+        db.metadata.create_all(engine)
+        return engine
+
+    def engine(self, clave, crear=False):
+        """Engine de una fábrica, abriéndolo si no está en caché"""
+        with self._lock:
+            if clave in self._engines:
+                engine, _ = self._engines.pop(clave)
+                self._engines[clave] = (engine, time.monotonic())
+                return engine
+
+        # Abrir y migrar sin el lock: no frena a las demás fábricas
+        engine = self.abrir(clave, crear)
+        desalojados = []
+        with self._lock:
+            if clave in self._engines:
+                # Otro hilo la abrió mientras tanto: se usa la suya
+                repetido = engine
+                engine, _ = self._engines.pop(clave)
+            else:
+                repetido = None
+            self._engines[clave] = (engine, time.monotonic())
+
+            while len(self._engines) > self.max_abiertos:
+                desalojados.append(self._engines.popitem(last=False))
+        if repetido is not None:
+            repetido.dispose()
+        for clave_vieja, (engine_viejo, _) in desalojados:
+            self._cerrar_engine(clave_vieja, engine_viejo)
+        return engine
+
+    def cerrar(self, clave):
+        """Cierra el engine de una fábrica (p. ej. antes de restaurarla)"""
+        with self._lock:
+            entrada = self._engines.pop(clave, None)
+        if entrada:
+            self._cerrar_engine(clave, entrada[0])
+
+    def cerrar_inactivas(self):
+        """Cierra las fábricas sin uso en los últimos `inactividad` segundos"""
+        limite = time.monotonic() - self.inactividad
+        with self._lock:
+            inactivas = [(c, e) for c, (e, uso) in self._engines.items() if uso < limite]
+            for clave, _ in inactivas:
+                del self._engines[clave]
+        for clave, engine in inactivas:
+            self._cerrar_engine(clave, engine)
+        return [clave for clave, _ in inactivas]
+
+    def _cerrar_engine(self, clave, engine):
+        engine.dispose()
+        for callback in self.al_cerrar:
+            callback(clave)
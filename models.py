@@ -5,11 +5,52 @@ Modelos de Base de Datos - Sistema de Gestión de Fábrica
 SQLAlchemy para SQLite
 """
 
+import os
+import sqlite3
+
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from datetime import datetime
+from flask_sqlalchemy.session import Session
+from sqlalchemy import MetaData, event, func, select, update, case
+from sqlalchemy.engine import Engine
+from datetime import datetime, time, timedelta
+
+
+# FABRICA_SQLITE_WAL=0 vuelve al journal clásico (p. ej. para comparar en
+# prueba_carga.py); se lee al importar, antes de abrir cualquier base
+SQLITE_WAL = os.environ.get('FABRICA_SQLITE_WAL', '1') == '1'
 
-db = SQLAlchemy()
+
+@event.listens_for(Engine, 'connect')
+def configurar_sqlite(conexion, _):
+    """Modo WAL en todas las bases SQLite (salvo con SQLITE_WAL desactivado)
+
+    Con WAL los lectores (incluido el respaldo en caliente) no bloquean a
+    los escritores; a cambio la base usa los archivos -wal y -shm junto al
+    .db y un respaldo largo retrasa el checkpoint, así que el -wal crece
+    mientras dura. El modo queda guardado en el archivo, por eso sin WAL
+    se vuelve explícitamente a DELETE.
+    """
+    if isinstance(conexion, sqlite3.Connection):
+        cursor = conexion.cursor()
+        modo = 'wal' if SQLITE_WAL else 'delete'
+        if cursor.execute('PRAGMA journal_mode').fetchone()[0] != modo:
+            cursor.execute(f'PRAGMA journal_mode = {modo}')
+        cursor.close()
+
+
+class SesionFabrica(Session):
+    """Sesión que usa el engine de la fábrica del request (g.engine_fabrica)"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            engine = g.get('engine_fabrica')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': SesionFabrica})
 
 
 class Producto(db.Model):
@@ -43,7 +84,7 @@ class Produccion(db.Model):
     __tablename__ = 'produccion'
     
     id = db.Column(db.Integer, primary_key=True)
-    producto_id = db.Column(db.Integer, db.ForeignKey('productos.id'), nullable=False)
+    producto_id = db.Column(db.Integer, db.ForeignKey('productos.id'), nullable=False, index=True)
     cantidad = db.Column(db.Integer, nullable=False)
     mes = db.Column(db.Integer, nullable=False)  # 1-12
     anio = db.Column(db.Integer, nullable=False)
@@ -71,12 +112,12 @@ class Venta(db.Model):
     __tablename__ = 'ventas'
     
     id = db.Column(db.Integer, primary_key=True)
-    producto_id = db.Column(db.Integer, db.ForeignKey('productos.id'), nullable=False)
-    produccion_id = db.Column(db.Integer, db.ForeignKey('produccion.id'), nullable=False)
+    producto_id = db.Column(db.Integer, db.ForeignKey('productos.id'), nullable=False, index=True)
+    produccion_id = db.Column(db.Integer, db.ForeignKey('produccion.id'), nullable=False, index=True)
     cantidad = db.Column(db.Integer, nullable=False)
     precio_aplicado = db.Column(db.Integer, nullable=False)
     descuento = db.Column(db.Integer, default=0)
-    fecha = db.Column(db.DateTime, default=datetime.now)
+    fecha = db.Column(db.DateTime, default=datetime.now, index=True)
     mes_venta = db.Column(db.Integer, nullable=False)
     anio_venta = db.Column(db.Integer, nullable=False)
     ganancia_real = db.Column(db.Integer, default=0)
@@ -104,7 +145,7 @@ class Gasto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     concepto = db.Column(db.String(200), nullable=False)
     monto = db.Column(db.Integer, nullable=False)
-    fecha = db.Column(db.DateTime, default=datetime.now)
+    fecha = db.Column(db.DateTime, default=datetime.now, index=True)
     mes_gasto = db.Column(db.Integer, nullable=False)
     anio_gasto = db.Column(db.Integer, nullable=False)
     tipo = db.Column(db.String(20), nullable=False)  # 'Fabrica' o 'Personal'
@@ -121,6 +162,93 @@ class Gasto(db.Model):
         }
 
 
+class ResumenArchivado(db.Model):
+    """Totales mensuales de los movimientos movidos al archivo anual"""
+    __tablename__ = 'resumen_archivado'
+    
+    anio = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.Integer, primary_key=True)
+    ventas = db.Column(db.Integer, default=0)  # En guaraníes
+    ganancias = db.Column(db.Integer, default=0)
+    gastos_fabrica = db.Column(db.Integer, default=0)
+    gastos_personal = db.Column(db.Integer, default=0)
+    unidades_vendidas = db.Column(db.Integer, default=0)
+    unidades_producidas = db.Column(db.Integer, default=0)
+    
+    def to_dict(self):
+        return {
+            'anio': self.anio,
+            'mes': self.mes,
+            'ventas': self.ventas,
+            'ganancias': self.ganancias,
+            'gastos_fabrica': self.gastos_fabrica,
+            'gastos_personal': self.gastos_personal,
+            'unidades_vendidas': self.unidades_vendidas,
+            'unidades_producidas': self.unidades_producidas
+        }
+
+
+def crear_indices(engine=None):
+    """Crea los índices declarados que falten en bases ya existentes"""
+    # create_all() no agrega índices nuevos a tablas que ya existen
+    for tabla in db.metadata.sorted_tables:
+        for indice in tabla.indexes:
+            indice.create(engine or db.engine, checkfirst=True)
+
+
+# Tablas de bases adjuntas (ATTACH), por nombre de esquema
+_tablas_esquema = {}
+
+
+def columnas_de(esquema=None):
+    """Columnas de Venta, Gasto y Produccion; con esquema, las de una base adjunta"""
+    if esquema is None:
+        return Venta, Gasto, Produccion
+    if esquema not in _tablas_esquema:
+        metadata = MetaData()
+        _tablas_esquema[esquema] = tuple(
+            modelo.__table__.to_metadata(metadata, schema=esquema).c
+            for modelo in (Venta, Gasto, Produccion)
+        )
+    return _tablas_esquema[esquema]
+
+
+def sumar_totales(*totales):
+    """Suma diccionarios de totales con las claves de calcular_totales_mes"""
+    claves = ('ventas', 'gastos_fabrica', 'gastos_personal', 'gastos_total', 'ganancias', 'balance')
+    return {clave: sum(t[clave] for t in totales) for clave in claves}
+
+
+def totales_archivados(mes=None, anio=None):
+    """Totales de los años archivados, leídos de resumen_archivado"""
+    filtros = []
+    if mes:
+        filtros.append(ResumenArchivado.mes == mes)
+    if anio:
+        filtros.append(ResumenArchivado.anio == anio)
+    
+    fila = db.session.query(
+        func.sum(ResumenArchivado.ventas),
+        func.sum(ResumenArchivado.ganancias),
+        func.sum(ResumenArchivado.gastos_fabrica),
+        func.sum(ResumenArchivado.gastos_personal),
+        func.sum(ResumenArchivado.unidades_vendidas),
+        func.sum(ResumenArchivado.unidades_producidas)
+    ).filter(*filtros).one()
+    ventas, ganancias, gastos_fabrica, gastos_personal, vendidas, producidas = (v or 0 for v in fila)
+    
+    return {
+        'ventas': ventas,
+        'gastos_fabrica': gastos_fabrica,
+        'gastos_personal': gastos_personal,
+        'gastos_total': gastos_fabrica + gastos_personal,
+        'ganancias': ganancias,
+        'balance': ventas - (gastos_fabrica + gastos_personal),
+        'unidades_vendidas': vendidas,
+        'unidades_producidas': producidas
+    }
+
+
 # Funciones auxiliares para cálculos financieros
 
 def calcular_costo_unitario_mes(mes, anio):
@@ -149,7 +277,10 @@ def calcular_dinero_total():
     
     total_gastos = db.session.query(func.sum(Gasto.monto)).scalar() or 0
     
-    return total_ventas - total_gastos
+    # Años archivados: desde los resúmenes, sin recorrer el historial
+    archivado = totales_archivados()
+    
+    return total_ventas - total_gastos + archivado['balance']
 
 
 def calcular_totales_mes(mes, anio):
@@ -174,27 +305,125 @@ def calcular_totales_mes(mes, anio):
         Venta.mes_venta == mes, Venta.anio_venta == anio
     ).scalar() or 0
     
-    return {
+    return sumar_totales({
         'ventas': total_ventas,
         'gastos_fabrica': gastos_fabrica,
         'gastos_personal': gastos_personal,
         'gastos_total': gastos_fabrica + gastos_personal,
         'ganancias': ganancias,
         'balance': total_ventas - (gastos_fabrica + gastos_personal)
+    }, totales_archivados(mes, anio))
+
+
+# Expresiones SQLite que dan la clave de período de una fecha. La semana se
+# identifica por su lunes: con '%Y-W%W' una semana que cruza el fin de año
+# quedaba partida en dos filas (2025-W52 y 2026-W00).
+GRANULARIDADES = {
+    'dia': lambda fecha: func.strftime('%Y-%m-%d', fecha),
+    'semana': lambda fecha: func.date(fecha, 'weekday 0', '-6 days'),
+    'mes': lambda fecha: func.strftime('%Y-%m', fecha)
+}
+
+
+def filtro_fechas(columna, desde=None, hasta=None):
+    """Condiciones de rango sobre una columna DateTime indexada (hasta inclusive)"""
+    filtros = []
+    if desde:
+        filtros.append(columna >= datetime.combine(desde, time.min))
+    if hasta:
+        filtros.append(columna < datetime.combine(hasta + timedelta(days=1), time.min))
+    return filtros
+
+
+def calcular_totales_rango(desde=None, hasta=None, esquema=None):
+    """Calcula los totales entre dos fechas (mismo formato que calcular_totales_mes)"""
+    Venta, Gasto, _ = columnas_de(esquema)
+    total_ventas, ganancias = db.session.query(
+        func.sum(Venta.precio_aplicado * Venta.cantidad - Venta.descuento),
+        func.sum(Venta.ganancia_real)
+    ).filter(*filtro_fechas(Venta.fecha, desde, hasta)).one()
+    
+    gastos_fabrica, gastos_personal = db.session.query(
+        func.sum(case((Gasto.tipo == 'Fabrica', Gasto.monto), else_=0)),
+        func.sum(case((Gasto.tipo == 'Personal', Gasto.monto), else_=0))
+    ).filter(*filtro_fechas(Gasto.fecha, desde, hasta)).one()
+    
+    total_ventas = total_ventas or 0
+    gastos_fabrica = gastos_fabrica or 0
+    gastos_personal = gastos_personal or 0
+    
+    return {
+        'ventas': total_ventas,
+        'gastos_fabrica': gastos_fabrica,
+        'gastos_personal': gastos_personal,
+        'gastos_total': gastos_fabrica + gastos_personal,
+        'ganancias': ganancias or 0,
+        'balance': total_ventas - (gastos_fabrica + gastos_personal)
     }
 
 
+def totales_por_periodo(desde=None, hasta=None, granularidad='mes', esquema=None):
+    """Totales agrupados por día, semana (desde su lunes) o mes, calculados en SQL"""
+    Venta, Gasto, _ = columnas_de(esquema)
+    periodo = GRANULARIDADES[granularidad]
+    periodo_venta = periodo(Venta.fecha)
+    periodo_gasto = periodo(Gasto.fecha)
+    
+    ventas = db.session.query(
+        periodo_venta,
+        func.sum(Venta.precio_aplicado * Venta.cantidad - Venta.descuento),
+        func.sum(Venta.ganancia_real)
+    ).filter(*filtro_fechas(Venta.fecha, desde, hasta)).group_by(periodo_venta).all()
+    
+    gastos = db.session.query(
+        periodo_gasto,
+        func.sum(case((Gasto.tipo == 'Fabrica', Gasto.monto), else_=0)),
+        func.sum(case((Gasto.tipo == 'Personal', Gasto.monto), else_=0))
+    ).filter(*filtro_fechas(Gasto.fecha, desde, hasta)).group_by(periodo_gasto).all()
+    
+    periodos = {}
+    for periodo, total, ganancias in ventas:
+        fila = periodos.setdefault(periodo, dict.fromkeys(
+            ('ventas', 'ganancias', 'gastos_fabrica', 'gastos_personal'), 0))
+        fila['ventas'] = total or 0
+        fila['ganancias'] = ganancias or 0
+    for periodo, fabrica, personal in gastos:
+        fila = periodos.setdefault(periodo, dict.fromkeys(
+            ('ventas', 'ganancias', 'gastos_fabrica', 'gastos_personal'), 0))
+        fila['gastos_fabrica'] = fabrica or 0
+        fila['gastos_personal'] = personal or 0
+    
+    resultado = []
+    for periodo in sorted(periodos):
+        fila = periodos[periodo]
+        gastos_total = fila['gastos_fabrica'] + fila['gastos_personal']
+        resultado.append({
+            'periodo': periodo,
+            **fila,
+            'gastos_total': gastos_total,
+            'balance': fila['ventas'] - gastos_total
+        })
+    return resultado
+
+
 def get_producciones_con_stock(producto_id):
     """Obtiene las producciones de un producto que aún tienen stock disponible"""
-    producciones = Produccion.query.filter_by(producto_id=producto_id).all()
+    # Vendido por lote en una sola consulta agrupada (sin N+1)
+    vendido_por_lote = db.session.query(
+        Venta.produccion_id.label('produccion_id'),
+        func.sum(Venta.cantidad).label('vendido')
+    ).join(Produccion, Produccion.id == Venta.produccion_id).filter(
+        Produccion.producto_id == producto_id
+    ).group_by(Venta.produccion_id).subquery()
+    
+    producciones = db.session.query(
+        Produccion, func.coalesce(vendido_por_lote.c.vendido, 0)
+    ).outerjoin(
+        vendido_por_lote, vendido_por_lote.c.produccion_id == Produccion.id
+    ).filter(Produccion.producto_id == producto_id).all()
     resultado = []
     
-    for prod in producciones:
-        # Calcular stock vendido de esta producción
-        vendido = db.session.query(func.sum(Venta.cantidad)).filter_by(
-            produccion_id=prod.id
-        ).scalar() or 0
-        
+    for prod, vendido in producciones:
         disponible = prod.cantidad - vendido
         
         if disponible > 0:
@@ -210,17 +439,118 @@ def get_producciones_con_stock(producto_id):
     return resultado
 
 
+def reparar_stock(productos=None):
+    """Recalcula stock_actual = producción - ventas en un único UPDATE
+    
+    Los totales se leen dentro de la misma sentencia que escribe, así una
+    venta confirmada mientras se auditaba no queda pisada por un valor
+    calculado antes. Con `productos` (ids) solo se corrigen esos. No hace
+    commit; devuelve los productos corregidos.
+    """
+    producido = select(func.coalesce(func.sum(Produccion.cantidad), 0)).where(
+        Produccion.producto_id == Producto.id).scalar_subquery()
+    vendido = select(func.coalesce(func.sum(Venta.cantidad), 0)).where(
+        Venta.producto_id == Producto.id).scalar_subquery()
+    esperado = producido - vendido
+    
+    consulta = update(Producto).where(Producto.stock_actual.is_distinct_from(esperado))
+    if productos is not None:
+        consulta = consulta.where(Producto.id.in_(productos))
+    resultado = db.session.execute(
+        consulta.values(stock_actual=esperado).execution_options(synchronize_session=False)
+    )
+    return resultado.rowcount
+
+
+def auditar_stock(reparar=False, productos=None):
+    """Compara stock_actual con producción - ventas y opcionalmente lo corrige
+    
+    Todo se calcula con dos consultas agrupadas (producción y ventas por
+    producto y lote), sin recorrer objetos Venta en Python. La reparación
+    (de todos o solo de `productos`) no hace commit: la confirma quien
+    llama (o la cola de escritura).
+    Nota: el stock inicial se registra como un lote al crear el producto;
+    en productos creados antes de eso aparece como discrepancia.
+    """
+    # Una sola pasada sobre ventas: total por (producto, lote)
+    ventas_agrupadas = db.session.query(
+        Venta.producto_id, Venta.produccion_id, func.sum(Venta.cantidad)
+    ).group_by(Venta.producto_id, Venta.produccion_id).all()
+    
+    lotes = db.session.query(
+        Produccion.id, Produccion.producto_id, Produccion.cantidad
+    ).all()
+    productos = db.session.query(
+        Producto.id, Producto.nombre, Producto.stock_actual
+    ).all()
+    
+    vendido_producto = {}
+    vendido_lote = {}
+    for producto_id, produccion_id, cantidad in ventas_agrupadas:
+        vendido_producto[producto_id] = vendido_producto.get(producto_id, 0) + cantidad
+        vendido_lote[produccion_id] = vendido_lote.get(produccion_id, 0) + cantidad
+    
+    producido_producto = {}
+    producto_de_lote = {}
+    lotes_sobrevendidos = []
+    for lote_id, producto_id, cantidad in lotes:
+        producto_de_lote[lote_id] = producto_id
+        producido_producto[producto_id] = producido_producto.get(producto_id, 0) + cantidad
+        vendido = vendido_lote.get(lote_id, 0)
+        if vendido > cantidad:
+            lotes_sobrevendidos.append({
+                'produccion_id': lote_id,
+                'producto_id': producto_id,
+                'cantidad': cantidad,
+                'vendido': vendido,
+                'disponible': cantidad - vendido
+            })
+    
+    # Ventas cuyo lote es de otro producto (o ya no existe)
+    ventas_lote_incorrecto = sum(
+        1 for producto_id, produccion_id, _ in ventas_agrupadas
+        if producto_de_lote.get(produccion_id) != producto_id
+    )
+    
+    discrepancias = []
+    for producto_id, nombre, stock_actual in productos:
+        esperado = producido_producto.get(producto_id, 0) - vendido_producto.get(producto_id, 0)
+        if (stock_actual or 0) != esperado:
+            discrepancias.append({
+                'producto_id': producto_id,
+                'nombre': nombre,
+                'stock_actual': stock_actual,
+                'stock_esperado': esperado,
+                'diferencia': (stock_actual or 0) - esperado
+            })
+    
+    if reparar and discrepancias:
+        reparar_stock(productos)
+    
+    return {
+        'productos_revisados': len(productos),
+        'lotes_revisados': len(lotes),
+        'discrepancias': discrepancias,
+        'lotes_sobrevendidos': lotes_sobrevendidos,
+        'grupos_venta_lote_incorrecto': ventas_lote_incorrecto,
+        'reparado': bool(reparar and discrepancias)
+    }
+
+
 def get_dashboard_stats():
     """Obtiene estadísticas para el dashboard"""
     from datetime import datetime
     
     mes_actual = datetime.now().month
     anio_actual = datetime.now().year
+    archivado = totales_archivados()
     
     return {
         'total_productos': Producto.query.filter_by(activo=True).count(),
-        'total_produccion': db.session.query(func.sum(Produccion.cantidad)).scalar() or 0,
-        'total_ventas': db.session.query(func.sum(Venta.cantidad)).scalar() or 0,
+        'total_produccion': (db.session.query(func.sum(Produccion.cantidad)).scalar() or 0)
+                            + archivado['unidades_producidas'],
+        'total_ventas': (db.session.query(func.sum(Venta.cantidad)).scalar() or 0)
+                        + archivado['unidades_vendidas'],
         'dinero_total': calcular_dinero_total(),
         'mes_actual': mes_actual,
         'anio_actual': anio_actual,
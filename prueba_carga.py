@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prueba de Carga - Sistema de Gestión de Fábrica
+Mezcla concurrente de ventas, gastos, dashboard y PDF contra una fábrica de prueba
+
+Uso:
+    python prueba_carga.py --hilos 8 --duracion 30 --mezcla venta=40,gasto=15,dashboard=30,pdf=5,reporte=10
+    python prueba_carga.py --sin-wal --timeout 10 --escritura-agrupada
+    python prueba_carga.py --url http://localhost:5000   # contra un servidor ya levantado
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+FABRICA_CARGA = 'carga'
+MEZCLA_DEFECTO = 'venta=40,gasto=15,dashboard=30,pdf=5,reporte=10'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Prueba de carga concurrente de la API')
+    parser.add_argument('--hilos', type=int, default=8, help='Clientes concurrentes')
+    parser.add_argument('--duracion', type=float, default=20, help='Segundos de carga')
+    parser.add_argument('--mezcla', default=MEZCLA_DEFECTO, help='Pesos por operación: op=peso,...')
+    parser.add_argument('--fabrica', default=FABRICA_CARGA, help='Fábrica (base) usada para la prueba')
+    parser.add_argument('--reiniciar', action='store_true', help='Borrar y volver a sembrar la fábrica')
+    parser.add_argument('--productos', type=int, default=20, help='Productos a sembrar')
+    parser.add_argument('--ventas', type=int, default=20000, help='Ventas históricas a sembrar')
+    parser.add_argument('--gastos', type=int, default=5000, help='Gastos históricos a sembrar')
+    parser.add_argument('--reintentos', type=int, default=3, help='Reintentos ante "database is locked"')
+    parser.add_argument('--timeout', type=float, default=None, help='busy timeout de SQLite (segundos)')
+    parser.add_argument('--sin-wal', dest='wal', action='store_false',
+                        help='Journal clásico en lugar de WAL (solo en proceso; con --url '
+                             'lo decide FABRICA_SQLITE_WAL del servidor)')
+    parser.add_argument('--escritura-agrupada', action='store_true', help='Activar la cola de group commit')
+    parser.add_argument('--ventana', type=float, default=None, help='Ventana de lote (segundos)')
+    parser.add_argument('--lote', type=int, default=None, help='Tamaño máximo de lote')
+    parser.add_argument('--url', default=None, help='Servidor HTTP a probar (por defecto, en proceso)')
+    parser.add_argument('--semilla', type=int, default=1, help='Semilla aleatoria')
+    parser.add_argument('--json', default=None, help='Guardar los resultados en este archivo')
+    return parser.parse_args()
+
+
+def parse_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(','):
+        operacion, peso = parte.split('=')
+        if operacion not in OPERACIONES:
+            raise SystemExit(f'Operación desconocida: {operacion} (use {", ".join(OPERACIONES)})')
+        mezcla[operacion] = float(peso)
+    return mezcla
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not valores:
+        return 0.0
+    indice = max(0, min(len(valores) - 1, int(round(p / 100 * len(valores) + 0.5)) - 1))
+    return valores[indice]
+
+
+# ============================================================================
+# SIEMBRA Y CONFIGURACIÓN (en proceso)
+# ============================================================================
+
+def sembrar(app, fabricas, usar_fabrica, args, rnd):
+    """Crea la fábrica de prueba con datos históricos; devuelve los lotes"""
+    from sqlalchemy import insert
+
+    from models import db, Producto, Produccion, Venta, Gasto
+
+    ruta = fabricas.ruta_db(args.fabrica)
+    if args.reiniciar and os.path.exists(ruta):
+        fabricas.cerrar(args.fabrica)
+        os.remove(ruta)
+
+    with app.app_context():
+        if not fabricas.existe(args.fabrica):
+            fabricas.crear(args.fabrica)
+            usar_fabrica(args.fabrica)
+            ahora = datetime.now()
+            unidades = (args.ventas * 3 + 1_000_000) // max(args.productos, 1)
+
+            productos = [Producto(nombre=f'Producto {i + 1}', precio_mayorista=8000 + i * 100,
+                                  precio_minorista=10000 + i * 100, stock_actual=0)
+                         for i in range(args.productos)]
+            db.session.add_all(productos)
+            db.session.flush()
+
+            lotes = []
+            por_id = {p.id: p for p in productos}
+            for producto in productos:
+                lote = Produccion(producto_id=producto.id, cantidad=unidades, mes=ahora.month,
+                                  anio=ahora.year, costo_unitario_calculado=4000)
+                lotes.append(lote)
+                producto.stock_actual = unidades
+            db.session.add_all(lotes)
+            db.session.flush()
+
+            filas = []
+            for _ in range(args.ventas):
+                lote = rnd.choice(lotes)
+                cantidad = rnd.randint(1, 3)
+                fecha = ahora - timedelta(days=rnd.randint(0, 365 * 2))
+                filas.append({
+                    'producto_id': lote.producto_id, 'produccion_id': lote.id, 'cantidad': cantidad,
+                    'precio_aplicado': 10000, 'descuento': 0, 'fecha': fecha,
+                    'mes_venta': fecha.month, 'anio_venta': fecha.year,
+                    'ganancia_real': (10000 - 4000) * cantidad
+                })
+                por_id[lote.producto_id].stock_actual -= cantidad
+            db.session.execute(insert(Venta), filas)
+
+            filas = []
+            for i in range(args.gastos):
+                fecha = ahora - timedelta(days=rnd.randint(0, 365 * 2))
+                filas.append({
+                    'concepto': f'Gasto de prueba {i}', 'monto': rnd.randint(10000, 500000),
+                    'fecha': fecha, 'mes_gasto': fecha.month, 'anio_gasto': fecha.year,
+                    'tipo': rnd.choice(('Fabrica', 'Personal'))
+                })
+            db.session.execute(insert(Gasto), filas)
+            db.session.commit()
+
+        usar_fabrica(args.fabrica)
+        return [(l.producto_id, l.id) for l in Produccion.query.all()]
+
+
+def configurar_sqlite(engine, args):
+    """Aplica el busy timeout a cada conexión nueva del engine
+
+    El modo WAL lo fija models.configurar_sqlite según FABRICA_SQLITE_WAL.
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'connect')
+    def al_conectar(conexion, _):
+        cursor = conexion.cursor()
+        if args.timeout is not None:
+            cursor.execute(f'PRAGMA busy_timeout = {int(args.timeout * 1000)}')
+        cursor.close()
+
+    engine.dispose()
+
+
+class MedidorEscritura:
+    """Mide cuánto tardan los escritores en DML y COMMIT (incluye la espera del lock)"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.tiempos_dml = []
+        self.tiempos_commit = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def antes(conn, cursor, sentencia, parametros, contexto, multiples):
+            conn.info['inicio_sql'] = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def despues(conn, cursor, sentencia, parametros, contexto, multiples):
+            if sentencia.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                self._agregar(self.tiempos_dml, time.perf_counter() - conn.info.pop('inicio_sql', 0))
+
+        @event.listens_for(engine, 'commit')
+        def al_commit(conn):
+            self._local.inicio_commit = time.perf_counter()
+
+        # El COMMIT real de pysqlite ocurre en do_commit del dialecto
+        do_commit = engine.dialect.do_commit
+
+        def do_commit_medido(conexion):
+            do_commit(conexion)
+            inicio = getattr(self._local, 'inicio_commit', None)
+            if inicio is not None:
+                self._agregar(self.tiempos_commit, time.perf_counter() - inicio)
+                self._local.inicio_commit = None
+
+        engine.dialect.do_commit = do_commit_medido
+
+    def _agregar(self, lista, valor):
+        with self._lock:
+            lista.append(valor)
+
+
+# ============================================================================
+# CLIENTES
+# ============================================================================
+
+class ClienteLocal:
+    """Llama a la app en proceso con el test client de Flask"""
+
+    def __init__(self, app, fabrica):
+        self.cliente = app.test_client()
+        self.headers = {'X-Fabrica': fabrica}
+
+    def llamar(self, metodo, url, data=None):
+        respuesta = self.cliente.open(url, method=metodo, json=data, headers=self.headers)
+        return respuesta.status_code, respuesta.get_data()
+
+
+class ErrorCliente(Exception):
+    """La petición no llegó al servidor (URL inválida, conexión, timeout)"""
+
+
+class ClienteHTTP:
+    """Llama a un servidor ya levantado por HTTP"""
+
+    def __init__(self, base, fabrica):
+        self.base = base.rstrip('/')
+        self.headers = {'X-Fabrica': fabrica, 'Content-Type': 'application/json'}
+
+    def llamar(self, metodo, url, data=None):
+        cuerpo = json.dumps(data).encode() if data is not None else None
+        peticion = urllib.request.Request(self.base + url, data=cuerpo, method=metodo, headers=self.headers)
+        try:
+            with urllib.request.urlopen(peticion, timeout=120) as respuesta:
+                return respuesta.status, respuesta.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+        except (urllib.error.URLError, http.client.InvalidURL, OSError) as e:
+            raise ErrorCliente(str(e))
+
+
+# ============================================================================
+# OPERACIONES
+# ============================================================================
+
+def op_venta(cliente, rnd, lotes):
+    producto_id, produccion_id = rnd.choice(lotes)
+    return cliente.llamar('POST', '/api/ventas', {
+        'producto_id': producto_id, 'produccion_id': produccion_id,
+        'cantidad': rnd.randint(1, 3), 'tipo_precio': rnd.choice(('mayorista', 'minorista')),
+        'descuento': rnd.choice((0, 0, 500))
+    })
+
+
+def op_gasto(cliente, rnd, lotes):
+    ahora = datetime.now()
+    return cliente.llamar('POST', '/api/gastos', {
+        'concepto': f'Carga {rnd.randint(1, 10 ** 6)}', 'monto': rnd.randint(10000, 200000),
+        'tipo': rnd.choice(('Fabrica', 'Personal')), 'mes': ahora.month, 'anio': ahora.year
+    })
+
+
+def op_dashboard(cliente, rnd, lotes):
+    return cliente.llamar('GET', '/api/dashboard')
+
+
+def op_pdf(cliente, rnd, lotes):
+    ahora = datetime.now()
+    return cliente.llamar('GET', '/api/reportes/pdf?' + urllib.parse.urlencode({'mes': ahora.month, 'anio': ahora.year}))
+
+
+def op_reporte(cliente, rnd, lotes):
+    hasta = datetime.now().date()
+    desde = hasta - timedelta(days=rnd.choice((7, 30, 90)))
+    return cliente.llamar('GET', '/api/reportes/datos?' + urllib.parse.urlencode(
+        {'desde': desde, 'hasta': hasta, 'granularidad': 'dia'}))
+
+
+def op_busqueda(cliente, rnd, lotes):
+    return cliente.llamar('GET', '/api/buscar?' + urllib.parse.urlencode(
+        {'q': f'gasto {rnd.randint(1, 99)}', 'por_pagina': 10}))
+
+
+OPERACIONES = {
+    'venta': op_venta,
+    'gasto': op_gasto,
+    'dashboard': op_dashboard,
+    'pdf': op_pdf,
+    'reporte': op_reporte,
+    'busqueda': op_busqueda
+}
+
+
+def es_lock(error_o_cuerpo):
+    """Error "database is locked": excepción en proceso o el 503 JSON de la app (también por --url)"""
+    return 'database is locked' in str(error_o_cuerpo)
+
+
+def trabajador(indice, crear_cliente, mezcla, lotes, args, fin, resultados, lock):
+    """Ejecuta operaciones al azar según la mezcla hasta que termina el tiempo"""
+    rnd = random.Random(args.semilla * 1000 + indice)
+    cliente = crear_cliente()
+    operaciones = list(mezcla)
+    pesos = [mezcla[o] for o in operaciones]
+    propios = {o: {'latencias': [], 'ok': 0, 'rechazadas': 0, 'errores': 0, 'cliente': 0, 'locked': 0,
+                   'reintentos': 0}
+               for o in operaciones}
+
+    while time.monotonic() < fin:
+        operacion = rnd.choices(operaciones, pesos)[0]
+        r = propios[operacion]
+        inicio = time.perf_counter()
+        for intento in range(args.reintentos + 1):
+            try:
+                status, cuerpo = OPERACIONES[operacion](cliente, rnd, lotes)
+                bloqueada = status >= 500 and es_lock(cuerpo)
+            except ErrorCliente:
+                status, bloqueada = None, False
+            except Exception as e:  # En proceso, los errores de SQLite llegan como excepción
+                status, bloqueada = 500, es_lock(e)
+            if not bloqueada:
+                break
+            r['locked'] += 1
+            if intento < args.reintentos:
+                r['reintentos'] += 1
+                time.sleep(0.01 * (2 ** intento))
+        r['latencias'].append(time.perf_counter() - inicio)
+        if status is None:
+            r['cliente'] += 1  # No llegó al servidor: no es un error del servidor
+        elif status < 400:
+            r['ok'] += 1
+        elif status < 500:
+            r['rechazadas'] += 1  # Validación (p. ej. stock insuficiente)
+        else:
+            r['errores'] += 1
+
+    with lock:
+        for operacion, r in propios.items():
+            total = resultados.setdefault(operacion, {k: ([] if k == 'latencias' else 0) for k in r})
+            for clave, valor in r.items():
+                total[clave] += valor
+
+
+# ============================================================================
+# PRINCIPAL
+# ============================================================================
+
+def main():
+    args = parse_args()
+    mezcla = parse_mezcla(args.mezcla)
+    rnd = random.Random(args.semilla)
+
+    # WAL y la cola de escritura se configuran antes de importar la app
+    if not args.wal:
+        os.environ['FABRICA_SQLITE_WAL'] = '0'
+    if args.escritura_agrupada:
+        os.environ['FABRICA_ESCRITURA_AGRUPADA'] = '1'
+    if args.ventana is not None:
+        os.environ['FABRICA_ESCRITURA_VENTANA'] = str(args.ventana)
+    if args.lote is not None:
+        os.environ['FABRICA_ESCRITURA_LOTE'] = str(args.lote)
+
+    from app import app, fabricas, usar_fabrica
+
+    print(f'Sembrando fábrica "{args.fabrica}"...')
+    lotes = sembrar(app, fabricas, usar_fabrica, args, rnd)
+
+    medidor = None
+    if args.url:
+        crear_cliente = lambda: ClienteHTTP(args.url, args.fabrica)
+    else:
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+        engine = fabricas.engine(args.fabrica)
+        configurar_sqlite(engine, args)
+        medidor = MedidorEscritura(engine)
+        crear_cliente = lambda: ClienteLocal(app, args.fabrica)
+
+    print(f'Carga: {args.hilos} hilos, {args.duracion:.0f} s, mezcla {mezcla}')
+    resultados = {}
+    lock = threading.Lock()
+    inicio = time.monotonic()
+    fin = inicio + args.duracion
+    hilos = [threading.Thread(target=trabajador,
+                              args=(i, crear_cliente, mezcla, lotes, args, fin, resultados, lock))
+             for i in range(args.hilos)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    transcurrido = time.monotonic() - inicio
+
+    informe = {
+        'configuracion': {
+            'hilos': args.hilos, 'duracion': args.duracion, 'mezcla': mezcla,
+            'wal': None if args.url else args.wal, 'timeout': args.timeout, 'escritura_agrupada': args.escritura_agrupada,
+            'ventana': args.ventana, 'lote': args.lote, 'url': args.url
+        },
+        'segundos': round(transcurrido, 2),
+        'endpoints': {}
+    }
+
+    print()
+    print(f'{"operación":<11}{"total":>8}{"ok":>8}{"rech.":>7}{"err.":>6}{"cli.":>6}{"req/s":>9}'
+          f'{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"locked":>8}{"reint.":>8}')
+    for operacion, r in sorted(resultados.items()):
+        latencias = sorted(r['latencias'])
+        fila = {
+            'total': len(latencias),
+            'ok': r['ok'],
+            'rechazadas': r['rechazadas'],
+            'errores': r['errores'],
+            'errores_cliente': r['cliente'],
+            'req_s': round(len(latencias) / transcurrido, 2),
+            'p50_ms': round(percentil(latencias, 50) * 1000, 2),
+            'p95_ms': round(percentil(latencias, 95) * 1000, 2),
+            'p99_ms': round(percentil(latencias, 99) * 1000, 2),
+            'locked': r['locked'],
+            'reintentos': r['reintentos']
+        }
+        informe['endpoints'][operacion] = fila
+        print(f'{operacion:<11}{fila["total"]:>8}{fila["ok"]:>8}{fila["rechazadas"]:>7}{fila["errores"]:>6}'
+              f'{fila["errores_cliente"]:>6}{fila["req_s"]:>9.1f}{fila["p50_ms"]:>9.1f}{fila["p95_ms"]:>9.1f}{fila["p99_ms"]:>9.1f}'
+              f'{fila["locked"]:>8}{fila["reintentos"]:>8}')
+
+    total = sum(f['total'] for f in informe['endpoints'].values())
+    print(f'\nTotal: {total} requests en {transcurrido:.1f} s ({total / transcurrido:.1f} req/s)')
+
+    if medidor:
+        informe['escritura'] = {}
+        for nombre, tiempos in (('dml', medidor.tiempos_dml), ('commit', medidor.tiempos_commit)):
+            tiempos = sorted(tiempos)
+            informe['escritura'][nombre] = {
+                'n': len(tiempos),
+                'total_s': round(sum(tiempos), 3),
+                'p50_ms': round(percentil(tiempos, 50) * 1000, 2),
+                'p95_ms': round(percentil(tiempos, 95) * 1000, 2),
+                'p99_ms': round(percentil(tiempos, 99) * 1000, 2),
+                'max_ms': round(tiempos[-1] * 1000, 2) if tiempos else 0
+            }
+            e = informe['escritura'][nombre]
+            print(f'Escritura {nombre:<7} n={e["n"]:<7} total={e["total_s"]:.2f} s  p50={e["p50_ms"]:.1f} ms  '
+                  f'p95={e["p95_ms"]:.1f} ms  p99={e["p99_ms"]:.1f} ms  max={e["max_ms"]:.1f} ms')
+    else:
+        print('Tiempos de lock de escritura: solo disponibles en modo en proceso (sin --url)')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(informe, f, indent=2)
+        print(f'Resultados guardados en {args.json}')
+
+
+if __name__ == '__main__':
+    main()